@@ -0,0 +1,462 @@
+"""
+async 版本的 webhook 伺服器 (ASGI)
+提供和 main.py 相同的 webhook、/trigger 與 /metrics 路由，
+集點後端與 LINE 都改用 async 的用戶端，一個行程就能同時處理大量事件
+
+處理流程和 main.py 相同，狀態與回覆內容都由 conversation.py 決定，
+這裡只有資料庫、集點後端與 LINE 的呼叫改成 async
+
+啟動方式：python asgi_app.py 或 uvicorn asgi_app:app
+
+"""
+
+import asyncio
+import os
+
+from linebot.v3.messaging import TextMessage
+from linebot.v3.webhooks import (
+    MessageEvent,
+    TextMessageContent,
+    FollowEvent,
+    UnfollowEvent,
+    PostbackEvent,
+)
+from linebot.exceptions import LineBotApiError
+
+import main
+import conversation
+import persistence as db
+import backend_client as backend
+import line_client
+import message_templates
+import stamp_client
+import membership
+import warmup
+import dedup
+import ratelimit
+import metrics
+from router import Router
+from outgoing import OutgoingMessages
+from main import process_message
+from conversation import (
+    STAMP_POSTBACKS,
+    createUserInfo,
+    check_id_number,
+    create_operation_options,
+)
+
+logger = main.app.logger
+
+# 還在處理中的事件，保留參考避免 task 被回收
+_tasks = set()
+
+# 每個使用者一把鎖，同一個使用者的事件依序處理
+_user_locks = {}
+
+
+# 資料庫是同步的 pymongo，丟到 thread 執行避免卡住 event loop
+async def _db(func, *args):
+    return await asyncio.to_thread(func, *args)
+
+
+# 和 main.stamp_correction 相同，先用預估的點數回覆後補送更正
+def stamp_correction(title: str, max_count: int):
+    async def correct(user_id, result):
+        messages = conversation.correction(title, max_count, result)
+        await OutgoingMessages(user_id).add(*messages).asend(line_client.get_async_api())
+
+    return correct
+
+
+async def get_user_info(user_id: str):
+    return await _db(db.get_or_create, user_id, createUserInfo(user_id))
+
+
+@metrics.timed("handler")
+async def handle_message(event):
+    user_id = event.source.user_id
+    user_info = await get_user_info(user_id)
+
+    # 和 main.handle_message 相同，一直輸入錯誤的使用者放慢處理速度
+    if user_info["steptype"] is not None:
+        reason = ratelimit.check_errcount(user_id, user_info["errcount"])
+        if reason != ratelimit.ALLOWED:
+            await shed_event(event, reason)
+            return
+
+    msg_list = await dispatch_type(user_id, event.message.text, user_info)
+
+    if len(msg_list) <= 0:
+        if user_info["register"] == False:
+            return
+        else:
+            msg_list = process_message(event.source.user_id, event.message.text)
+
+    if len(msg_list) > 0:
+        outgoing = OutgoingMessages.for_event(event).add(*msg_list)
+        await outgoing.asend(line_client.get_async_api())
+
+
+# 路由表和 main.message_router / main.postback_router 相同，
+# 流程的判斷都在 conversation.py，這裡只把資料庫與後端的呼叫換成 async
+message_router = Router("message")
+postback_router = Router("postback")
+metrics.add_source(
+    "routes", lambda: {"message": message_router.stats(), "postback": postback_router.stats()}
+)
+
+
+# 和 main.dispatch_type 相同的流程
+@metrics.timed("handler")
+async def dispatch_type(user_id: str, message: str, user_info) -> list:
+    handler = message_router.dispatch(
+        user_info["steptype"], user_info["step"], message, user_id, message, user_info
+    )
+    if handler is None:
+        return []
+    return await handler
+
+
+@message_router.route("新會員")
+async def start_register(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.start_register(user_info)
+    await _db(db.update_data, user_id, user_info)
+    return msg_list
+
+
+@message_router.route("連結LINE集點", "登入")
+async def start_link(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.start_link(user_info)
+    await _db(db.update_data, user_id, user_info)
+    return msg_list
+
+
+@message_router.route("集點")
+async def stamp_message(user_id: str, message: str, user_info) -> list:
+    category, title, max_count = conversation.STAMP_MESSAGE
+    result = await stamp_client.aadd(
+        user_info["user_id"], category, stamp_correction(title, max_count)
+    )
+    return conversation.stamp_reply(result)
+
+
+@message_router.route("所有集點")
+async def all_stamps(user_id: str, message: str, user_info) -> list:
+    return [create_operation_options()]
+
+
+@message_router.route(steptype="連結LINEID")
+async def link_line_id(user_id: str, message: str, user_info) -> list:
+    if not check_id_number(message):
+        msg_list = conversation.input_error(user_info, conversation.LINK_FORMAT_ERROR)
+        await _db(db.update_data, user_id, user_info)
+        return msg_list
+
+    try:
+        response = await backend.apost(
+            "/linkLineID/",
+            json={"idNumber": message, "lineId": user_id},
+        )
+    except Exception as e:
+        logger.error(f"Error during request: {e}")
+        response = None
+    msg_list = conversation.link_result(user_info, message, response)
+    await _db(db.update_data, user_id, user_info)
+    return msg_list
+
+
+@message_router.route(steptype="新會員", step=1)
+async def register_name(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.register_name(user_info, message)
+    await _db(db.update_data, user_id, user_info)
+    return msg_list
+
+
+@message_router.route(steptype="新會員", step=2)
+async def register_id_number(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.register_id_number(user_info, message)
+    await _db(db.update_data, user_id, user_info)
+    return msg_list
+
+
+@message_router.route(steptype="新會員", step=3)
+async def register_tel(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.register_tel(user_info, message)
+    await _db(db.update_data, user_id, user_info)
+    return msg_list
+
+
+@message_router.route(steptype="新會員", step=4)
+async def register_login(user_id: str, message: str, user_info) -> list:
+    if not check_id_number(message):
+        msg_list = conversation.input_error(user_info, conversation.LOGIN_FORMAT_ERROR)
+        await _db(db.update_data, user_id, user_info)
+        return msg_list
+
+    user_info["idNumber"] = message
+    try:
+        registered = await membership.aid_registered(message)
+        msg_list = conversation.login_result(user_info, registered)
+        if registered:
+            await _db(db.update_data, user_id, user_info)
+            try:
+                response = await backend.apost(
+                    "/linkLineID/",
+                    json={"idNumber": message, "lineId": user_id},
+                )
+                if response.status_code == 200:
+                    conversation.linked(user_id, message)
+            except Exception as e:
+                logger.error(f"Error during request: {e}")
+        return msg_list
+    except:
+        return conversation.text_reply(conversation.CONTACT_ADMIN)
+
+
+@metrics.timed("handler")
+async def handle_postback(event):
+    user_id = event.source.user_id
+    user_info = await get_user_info(user_id)
+    # 要送出的訊息都先放這裡，最後合併成一次回覆
+    outgoing = OutgoingMessages.for_event(event)
+    handler = postback_router.dispatch(
+        None, None, event.postback.data, event, user_info, outgoing
+    )
+    if handler is not None:
+        await handler
+    await outgoing.asend(line_client.get_async_api())
+
+
+@postback_router.route("correct")
+async def confirm_register(event, user_info, outgoing):
+    try:
+        response = await backend.apost("/add_user/", json=conversation.member_data(user_info))
+        msg_list = conversation.register_result(user_info, response.status_code)
+        if response.status_code == 200:
+            await _db(db.update_data, user_info["user_id"], user_info)
+    except:
+        msg_list = conversation.text_reply(conversation.CONTACT_ADMIN)
+    outgoing.add(*msg_list)
+
+
+@postback_router.route("incorrect")
+async def restart_register(event, user_info, outgoing):
+    user_id = event.source.user_id
+    user_info, msg_list = conversation.restart_register(user_id)
+    await _db(db.update_data, user_id, user_info)
+    outgoing.add(*msg_list)
+
+
+@postback_router.route("start")
+async def start_menu(event, user_info, outgoing):
+    outgoing.add(message_templates.START_MENU)
+
+
+@postback_router.route("logout")
+async def logout(event, user_info, outgoing):
+    conversation.reset_steps(user_info)
+    await _db(db.update_data, user_info["user_id"], user_info)
+
+    try:
+        response = await backend.adelete(
+            "/logout/",
+            json={"lineId": user_info["user_id"]},
+        )
+        msg_list = conversation.logout_result(user_info, response.status_code)
+    except Exception as e:
+        logger.error(f"Error during request: {e}")
+        msg_list = conversation.text_reply(conversation.CONTACT_ADMIN)
+    outgoing.add(*msg_list)
+
+
+@postback_router.route(*STAMP_POSTBACKS)
+async def stamp_postback(event, user_info, outgoing):
+    category, title, max_count, _ = STAMP_POSTBACKS[event.postback.data]
+    result = await stamp_client.aadd(
+        user_info["user_id"], category, stamp_correction(title, max_count)
+    )
+    conversation.add_stamp_postback_reply(outgoing, event.postback.data, result)
+
+
+async def handle_follow(event):
+    logger.info("Got Follow event", extra={"user_id": event.source.user_id})
+    msg_list = []
+    line_bot_api = line_client.get_async_api()
+
+    try:
+        profile = await line_bot_api.get_profile(event.source.user_id)
+        msg_list = conversation.welcome(profile)
+    except LineBotApiError as e:
+        logger.error("Error while getting profile", extra={"status": e.status_code})
+
+    if len(msg_list) > 0:
+        await OutgoingMessages.for_event(event).add(*msg_list).asend(line_bot_api)
+
+
+async def handle_unfollow(event):
+    logger.info("Got Unfollow event", extra={"user_id": event.source.user_id})
+    await _db(db.forget_user, event.source.user_id)
+    stamp_client.forget(event.source.user_id)
+
+
+# 和 main.shed_event 相同，被限制的事件回覆固定的提示或直接丟掉
+async def shed_event(event, reason):
+    text = ratelimit.notice(event, reason)
+    if text is None:
+        return
+    try:
+        outgoing = OutgoingMessages.for_event(event).add(TextMessage(text=text))
+        await outgoing.asend(line_client.get_async_api())
+    except Exception as e:
+        logger.error(f"Error while sending rate limit notice: {e}")
+
+
+async def dispatch_event(event):
+    if isinstance(event, MessageEvent):
+        if isinstance(event.message, TextMessageContent):
+            await handle_message(event)
+    elif isinstance(event, PostbackEvent):
+        await handle_postback(event)
+    elif isinstance(event, FollowEvent):
+        await handle_follow(event)
+    elif isinstance(event, UnfollowEvent):
+        await handle_unfollow(event)
+
+
+# 查過共用的重複事件紀錄後才處理
+async def _handle(event):
+    try:
+        if await _db(dedup.deduplicator.seen_shared, event):
+            return
+        await dispatch_event(event)
+    except Exception as e:
+        logger.error(f"Error: {e}")
+
+
+# 同一個使用者的事件排隊處理，不同使用者可以同時進行
+# task 依照建立的順序開始執行，在第一個 await 之前就排進使用者的鎖，
+# 事件才會照收到的順序處理，共用紀錄的查詢要在鎖裡面做
+async def _run_in_order(event):
+    key = getattr(event.source, "user_id", None)
+    if key is None:
+        await _handle(event)
+        return
+
+    entry = _user_locks.get(key)
+    if entry is None:
+        entry = _user_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            await _handle(event)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _user_locks[key]
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+async def _respond(send, status: int, text: str, content_type: str = "text/html; charset=utf-8"):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type.encode())],
+        }
+    )
+    await send({"type": "http.response.body", "body": text.encode("utf-8")})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            db.init_db()
+            main.load_health_info("bot_health_info.json")
+            warmup.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _tasks:
+                await asyncio.wait(list(_tasks), timeout=10)
+            warmup.stop()
+            await backend.aclose()
+            await line_client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    method = scope["method"]
+
+    if path == main.webhook and method == "POST":
+        headers = dict(scope["headers"])
+        signature = headers.get(b"x-line-signature")
+        if signature is None:
+            await _respond(send, 400, "Bad Request")
+            return
+
+        body = (await _read_body(receive)).decode("utf-8")
+        with metrics.track("handler", "linebot"):
+            try:
+                # 驗證簽章後把事件排進 event loop，馬上回覆 LINE
+                for event in main.handler.parser.parse(body, signature.decode()):
+                    # 這個行程內看過的事件直接丟掉，共用的紀錄在 task 裡查
+                    if dedup.deduplicator.seen_locally(event):
+                        continue
+                    reason = ratelimit.check(event)
+                    if reason != ratelimit.ALLOWED:
+                        _spawn(shed_event(event, reason))
+                        continue
+                    _spawn(_run_in_order(event))
+            except Exception as e:
+                logger.error(f"Error: {e}")
+        await _respond(send, 200, "OK")
+    elif path == "/trigger" and method in ("GET", "POST"):
+        await _respond(send, 200, "OKOK")
+    elif path == "/metrics" and method == "GET":
+        await _respond(send, 200, metrics.render(), metrics.CONTENT_TYPE)
+    else:
+        await _respond(send, 404, "Not Found")
+
+
+def run():
+    import uvicorn
+
+    host_ip = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", 5000))
+
+    if os.getenv("HTTPTYPE") == "https":
+        uvicorn.run(
+            app,
+            host=host_ip,
+            port=port,
+            ssl_certfile=os.getenv("certfile"),
+            ssl_keyfile=os.getenv("keyfile"),
+        )
+    else:
+        uvicorn.run(app, host=host_ip, port=port)
+
+
+if __name__ == "__main__":
+    run()
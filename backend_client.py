@@ -0,0 +1,378 @@
+"""
+集點後端 (BASE_URL) 的 HTTP 用戶端
+所有呼叫共用同一個 requests.Session，保留連線不用每次重新握手
+
+每個 endpoint 有各自的 connect/read timeout，
+冪等的呼叫遇到連線錯誤或 5xx 會加上隨機延遲後重試，
+並記錄每個 endpoint 的延遲分佈
+
+asgi_app 使用 arequest 等 async 版本，底層是 aiohttp，
+timeout、重試規則和延遲統計都跟同步版本共用
+
+後端連續失敗時斷路器會打開，這段期間的呼叫直接丟出 BackendUnavailable，
+不會再連線等待 timeout，過一段時間後先放一個請求試探，成功才恢復
+
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+import aiohttp
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+load_dotenv()
+
+BASE_URL = os.getenv("BACKEND_URL", "https://linebotapi-tgkg.onrender.com")
+
+POOL_SIZE = int(os.getenv("BACKEND_POOL_SIZE", 10))
+ASYNC_POOL_SIZE = int(os.getenv("BACKEND_ASYNC_POOL_SIZE", 100))
+MAX_RETRIES = int(os.getenv("BACKEND_RETRIES", 2))
+RETRY_BACKOFF = float(os.getenv("BACKEND_RETRY_BACKOFF", 0.2))
+
+# 預設的 (connect, read) timeout，單位秒
+DEFAULT_TIMEOUT = (
+    float(os.getenv("BACKEND_CONNECT_TIMEOUT", 3.05)),
+    float(os.getenv("BACKEND_READ_TIMEOUT", 10)),
+)
+
+# 各個 endpoint 的 timeout，查詢類的比較短
+TIMEOUTS = {
+    "/searchLineID/": (DEFAULT_TIMEOUT[0], 5),
+    "/search/": (DEFAULT_TIMEOUT[0], 5),
+}
+
+# 可以安全重試的呼叫，/add/* 會累加點數所以不能重試
+IDEMPOTENT = {
+    ("POST", "/searchLineID/"),
+    ("GET", "/search/"),
+    ("DELETE", "/logout/"),
+}
+
+RETRY_STATUS = {502, 503, 504}
+
+# 連續失敗幾次後打開斷路器，打開後幾秒才試探
+BREAKER_THRESHOLD = int(os.getenv("BACKEND_BREAKER_THRESHOLD", 5))
+BREAKER_RESET = float(os.getenv("BACKEND_BREAKER_RESET", 30))
+
+# 延遲分佈的區間上限，單位毫秒
+BUCKETS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+_session = None
+_async_session = None
+_lock = threading.Lock()
+_latency = {}
+# 最後一次呼叫後端的時間 (time.monotonic)
+_last_activity = 0.0
+
+
+# 斷路器打開時丟出，繼承 ConnectionError，原本處理連線錯誤的地方都能接到
+class BackendUnavailable(requests.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30):
+        self.threshold = max(1, threshold)
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        # 半開狀態時是否已經有試探的請求
+        self.probing = False
+        self.probe_started = 0.0
+
+        # 統計資料
+        self.trips = 0
+        self.rejected = 0
+
+    # 是否可以送出請求
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.probing = False
+            # 半開時只放一個請求試探，試探的請求沒有結果太久就再放一個
+            now = time.monotonic()
+            if self.probing and now - self.probe_started < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.probing = True
+            self.probe_started = now
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "open_for": (
+                    round(time.monotonic() - self.opened_at, 3)
+                    if self.state == self.OPEN
+                    else 0.0
+                ),
+            }
+
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET)
+
+
+def _check_breaker(endpoint: str):
+    if not breaker.allow():
+        raise BackendUnavailable(f"backend circuit open: {endpoint}")
+
+
+def build_url(path: str) -> str:
+    return f"{BASE_URL}{path}"
+
+
+# 取得共用的 session，第一次呼叫時才建立
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def close():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _observe(endpoint: str, elapsed: float, error: bool):
+    global _last_activity
+    elapsed_ms = elapsed * 1000
+    with _lock:
+        _last_activity = time.monotonic()
+        stat = _latency.get(endpoint)
+        if stat is None:
+            stat = {"count": 0, "errors": 0, "sum_ms": 0.0, "buckets": [0] * len(BUCKETS)}
+            _latency[endpoint] = stat
+        stat["count"] += 1
+        stat["sum_ms"] += elapsed_ms
+        if error:
+            stat["errors"] += 1
+        for index, bound in enumerate(BUCKETS):
+            if elapsed_ms <= bound:
+                stat["buckets"][index] += 1
+                break
+
+
+# 5xx 算失敗，其他的回應表示後端還活著
+def _record(status_code: int):
+    if status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+# 送出請求，用法和 requests.request 相同，只是 url 改成 path
+# metrics 記錄的是整個呼叫 (包含重試) 的時間
+def request(method: str, path: str, **kwargs) -> requests.Response:
+    with metrics.track("backend", f"{method.upper()} {path}") as span:
+        response = _request(method, path, **kwargs)
+        span.error = response.status_code >= 500
+        return response
+
+
+def _request(method: str, path: str, **kwargs) -> requests.Response:
+    method = method.upper()
+    endpoint = f"{method} {path}"
+    kwargs.setdefault("timeout", TIMEOUTS.get(path, DEFAULT_TIMEOUT))
+    retries = MAX_RETRIES if (method, path) in IDEMPOTENT else 0
+    url = build_url(path)
+
+    attempt = 0
+    while True:
+        _check_breaker(endpoint)
+        start = time.monotonic()
+        try:
+            response = get_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            _observe(endpoint, time.monotonic() - start, True)
+            breaker.record_failure()
+            if attempt >= retries:
+                raise
+        else:
+            retry = response.status_code in RETRY_STATUS and attempt < retries
+            _observe(endpoint, time.monotonic() - start, response.status_code >= 500)
+            _record(response.status_code)
+            if not retry:
+                return response
+
+        # 指數退避加上隨機延遲，避免大家同時重試
+        attempt += 1
+        time.sleep(random.uniform(0, RETRY_BACKOFF * (2 ** (attempt - 1))))
+
+
+def get(path: str, **kwargs) -> requests.Response:
+    return request("GET", path, **kwargs)
+
+
+def post(path: str, **kwargs) -> requests.Response:
+    return request("POST", path, **kwargs)
+
+
+def put(path: str, **kwargs) -> requests.Response:
+    return request("PUT", path, **kwargs)
+
+
+def delete(path: str, **kwargs) -> requests.Response:
+    return request("DELETE", path, **kwargs)
+
+
+# async 版本回傳的結果，提供和 requests.Response 一樣的 status_code 與 json()
+class AsyncResponse:
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+# 取得共用的 aiohttp session，必須在 event loop 裡呼叫
+def get_async_session() -> aiohttp.ClientSession:
+    global _async_session
+    if _async_session is None or _async_session.closed:
+        connector = aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE)
+        _async_session = aiohttp.ClientSession(connector=connector)
+    return _async_session
+
+
+async def aclose():
+    global _async_session
+    if _async_session is not None:
+        await _async_session.close()
+        _async_session = None
+
+
+async def arequest(method: str, path: str, **kwargs) -> AsyncResponse:
+    with metrics.track("backend", f"{method.upper()} {path}") as span:
+        response = await _arequest(method, path, **kwargs)
+        span.error = response.status_code >= 500
+        return response
+
+
+async def _arequest(method: str, path: str, **kwargs) -> AsyncResponse:
+    method = method.upper()
+    endpoint = f"{method} {path}"
+    connect_timeout, read_timeout = kwargs.pop(
+        "timeout", TIMEOUTS.get(path, DEFAULT_TIMEOUT)
+    )
+    kwargs["timeout"] = aiohttp.ClientTimeout(
+        sock_connect=connect_timeout, sock_read=read_timeout
+    )
+    retries = MAX_RETRIES if (method, path) in IDEMPOTENT else 0
+    url = build_url(path)
+
+    attempt = 0
+    while True:
+        _check_breaker(endpoint)
+        start = time.monotonic()
+        try:
+            async with get_async_session().request(method, url, **kwargs) as resp:
+                response = AsyncResponse(resp.status, await resp.text())
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            _observe(endpoint, time.monotonic() - start, True)
+            breaker.record_failure()
+            if attempt >= retries:
+                raise
+        else:
+            retry = response.status_code in RETRY_STATUS and attempt < retries
+            _observe(endpoint, time.monotonic() - start, response.status_code >= 500)
+            _record(response.status_code)
+            if not retry:
+                return response
+
+        attempt += 1
+        await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * (2 ** (attempt - 1))))
+
+
+async def aget(path: str, **kwargs) -> AsyncResponse:
+    return await arequest("GET", path, **kwargs)
+
+
+async def apost(path: str, **kwargs) -> AsyncResponse:
+    return await arequest("POST", path, **kwargs)
+
+
+async def aput(path: str, **kwargs) -> AsyncResponse:
+    return await arequest("PUT", path, **kwargs)
+
+
+async def adelete(path: str, **kwargs) -> AsyncResponse:
+    return await arequest("DELETE", path, **kwargs)
+
+
+# 每個 endpoint 的呼叫次數、錯誤次數與延遲分佈
+def stats() -> dict:
+    with _lock:
+        result = {}
+        for endpoint, stat in _latency.items():
+            result[endpoint] = {
+                "count": stat["count"],
+                "errors": stat["errors"],
+                "avg_ms": stat["sum_ms"] / stat["count"] if stat["count"] else 0.0,
+                "buckets": {
+                    ("+Inf" if bound == float("inf") else str(bound)): count
+                    for bound, count in zip(BUCKETS, stat["buckets"])
+                },
+            }
+        return result
+
+
+def breaker_stats() -> dict:
+    return breaker.stats()
+
+
+# 距離最後一次呼叫後端過了幾秒，還沒呼叫過時回傳 None
+def idle_seconds():
+    with _lock:
+        if not _last_activity:
+            return None
+        return time.monotonic() - _last_activity
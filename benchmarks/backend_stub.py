@@ -0,0 +1,180 @@
+"""
+本機的假集點後端，測試時不用連到真正的 BASE_URL
+把環境變數 BACKEND_URL 設成 http://127.0.0.1:<port> 就會改送到這裡
+
+支援會員查詢 (/searchLineID/、/search/)、註冊 (/add_user/)、連結 (/linkLineID/)、
+登出 (/logout/) 與集點 (/add/<類別>)，資料只存在記憶體中，
+可以加上固定延遲與隨機錯誤
+
+GET /stats 取得各個 endpoint 收到的請求數，POST /stats/reset 歸零
+
+執行方式：python benchmarks/backend_stub.py [--port 8091] [--latency 0.05] [--error-rate 0.01]
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CATEGORIES = ("healthMeasurement", "healthEducation", "exercise")
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.errors = 0
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {"requests": dict(self.counts), "errors": self.errors}
+
+
+class Store:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 身分證字號 -> 會員資料
+        self.members = {}
+        # LINE ID -> 身分證字號
+        self.links = {}
+        # LINE ID -> 各類別的點數
+        self.points = {}
+
+
+def make_handler(stats: Stats, store: Store, latency: float, error_rate: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, body: dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        # GET 也可能帶 JSON (/search/)
+        def _read_json(self) -> dict:
+            length = int(self.headers.get("Content-Length", 0))
+            if length <= 0:
+                return {}
+            return json.loads(self.rfile.read(length))
+
+        # 共用的延遲與錯誤，回傳 True 表示已經回應錯誤
+        def _inject(self, name: str) -> bool:
+            with stats.lock:
+                stats.counts[name] = stats.counts.get(name, 0) + 1
+            if latency > 0:
+                time.sleep(latency)
+            if error_rate > 0 and random.random() < error_rate:
+                with stats.lock:
+                    stats.errors += 1
+                self._send(500, {"detail": "injected error"})
+                return True
+            return False
+
+        def _handle(self, method: str):
+            body = self._read_json()
+            path = self.path
+
+            if method == "GET" and path == "/stats":
+                self._send(200, stats.to_dict())
+                return
+            if method == "POST" and path == "/stats/reset":
+                with stats.lock:
+                    stats.reset()
+                self._send(200, {})
+                return
+
+            name = f"{method} {path}"
+            if self._inject(name):
+                return
+
+            with store.lock:
+                if method == "GET" and path == "/":
+                    self._send(200, {"status": "ok"})
+                elif method == "POST" and path == "/searchLineID/":
+                    found = body.get("lineId") in store.links
+                    self._send(200 if found else 404, {"found": found})
+                elif method == "GET" and path == "/search/":
+                    found = body.get("idNumber") in store.members
+                    self._send(200 if found else 404, {"found": found})
+                elif method == "POST" and path == "/add_user/":
+                    if body.get("idNumber") in store.members:
+                        self._send(400, {"detail": "已經註冊過了"})
+                    else:
+                        store.members[body.get("idNumber")] = body
+                        self._send(200, body)
+                elif method == "POST" and path == "/linkLineID/":
+                    if body.get("idNumber") not in store.members:
+                        self._send(400, {"detail": "請先註冊"})
+                    else:
+                        store.links[body.get("lineId")] = body.get("idNumber")
+                        self._send(200, body)
+                elif method == "DELETE" and path == "/logout/":
+                    store.links.pop(body.get("lineId"), None)
+                    self._send(200, {})
+                elif method == "PUT" and path.startswith("/add/"):
+                    category = path[len("/add/"):]
+                    if category not in CATEGORIES:
+                        self._send(404, {"detail": "Not found"})
+                        return
+                    points = store.points.setdefault(body.get("lineId"), {})
+                    points[category] = points.get(category, 0) + 1
+                    self._send(200, {"lineId": body.get("lineId"), **points})
+                else:
+                    self._send(404, {"detail": "Not found"})
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_PUT(self):
+            self._handle("PUT")
+
+        def do_DELETE(self):
+            self._handle("DELETE")
+
+    return Handler
+
+
+# 在背景啟動，回傳 (server, stats)，測試程式結束時呼叫 server.shutdown()
+def serve(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, error_rate: float = 0.0):
+    stats = Stats()
+    handler = make_handler(stats, Store(), latency, error_rate)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="假的集點後端伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--latency", type=float, default=0.0, help="每個請求的延遲秒數")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回 500 的比例")
+    args = parser.parse_args()
+
+    server, _ = serve(args.host, args.port, args.latency, args.error_rate)
+    print(f"Backend stub listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
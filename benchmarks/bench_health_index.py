@@ -0,0 +1,52 @@
+"""
+比較逐一檢查每個關鍵字是否出現在訊息中，和 health_index 的 Aho–Corasick 索引
+關鍵字數量越多，逐一檢查越慢，索引的查詢時間只跟訊息長度有關
+
+執行方式：python benchmarks/bench_health_index.py [關鍵字數量] [次數]
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from health_index import HealthIndex  # noqa: E402
+
+CHARS = "血壓心跳糖體重運動飲食睡眠頭痛發燒咳嗽腰酸背痛膽固醇肝腎功能視力聽力牙齒皮膚過敏"
+
+
+def make_entries(count: int) -> dict:
+    random.seed(0)
+    entries = {}
+    while len(entries) < count:
+        key = "".join(random.choices(CHARS, k=random.randint(3, 5)))
+        entries[key] = f"關於{key}的衛教內容"
+    return entries
+
+
+# 舊的做法改成包含比對：每個關鍵字都檢查一次
+def naive_lookup(entries: dict, message: str) -> list:
+    return [answer for key, answer in entries.items() if key in message]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    entries = make_entries(count)
+    index = HealthIndex.from_dict(entries)
+    key = next(iter(entries))
+    message = f"請問我的{key}多少算正常，需要看醫生嗎"
+
+    assert index.lookup(message)[0] == entries[key]
+
+    naive = timeit.timeit(lambda: naive_lookup(entries, message), number=number)
+    indexed = timeit.timeit(lambda: index.lookup(message), number=number)
+    print(f"{count} 個關鍵字，{number} 次查詢")
+    print(f"逐一檢查: {naive / number * 1e6:.1f} us/次")
+    print(f"索引查詢: {indexed / number * 1e6:.1f} us/次")
+
+
+if __name__ == "__main__":
+    main()
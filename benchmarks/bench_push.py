@@ -0,0 +1,62 @@
+"""
+比較一個人一次推送，和透過 push_pipeline 合併成 multicast 的差異
+會在本機啟動假的 LINE 伺服器 (line_stub.py)，不會真的送出訊息
+
+執行方式：python benchmarks/bench_push.py [人數] [每秒請求數上限]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import line_stub  # noqa: E402
+
+server, stub_stats = line_stub.serve(
+    latency=0.01, rate_limit=int(sys.argv[2]) if len(sys.argv) > 2 else 0
+)
+os.environ["LINE_API_HOST"] = f"http://127.0.0.1:{server.server_address[1]}"
+os.environ.setdefault("ACCESS_TOKEN", "stub")
+
+from linebot.v3.messaging import PushMessageRequest, TextMessage  # noqa: E402
+
+import line_client  # noqa: E402
+import push_pipeline  # noqa: E402
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    user_ids = [f"U{index:032d}" for index in range(users)]
+    messages = [TextMessage(text="提醒您今天記得量血壓喔~")]
+    line_bot_api = line_client.get_api()
+
+    # 舊的做法：一個人呼叫一次 push
+    started = time.perf_counter()
+    for user_id in user_ids:
+        line_bot_api.push_message_with_http_info(
+            PushMessageRequest(to=user_id, messages=messages)
+        )
+    sequential = time.perf_counter() - started
+    sequential_calls = stub_stats.to_dict()["requests"].get("push", 0)
+
+    with stub_stats.lock:
+        stub_stats.reset()
+
+    pipeline = push_pipeline.PushPipeline(rate=100, burst=20, linger=0.2)
+    pipeline.start()
+    started = time.perf_counter()
+    pipeline.multicast(user_ids, messages)
+    pipeline.stop(timeout=600)
+    batched = time.perf_counter() - started
+
+    print(f"逐一推送: {users} 人, {sequential_calls} 次呼叫, {sequential:.2f}s")
+    print(f"合併推送: {users} 人, {batched:.2f}s")
+    print("pipeline:", pipeline.stats())
+    print("stub:", stub_stats.to_dict())
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
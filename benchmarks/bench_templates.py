@@ -0,0 +1,66 @@
+"""
+比較每個事件重新建立選單訊息，和直接使用 message_templates 預先建立好的訊息的成本
+
+執行方式：python benchmarks/bench_templates.py [次數]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from linebot.v3.messaging import (  # noqa: E402
+    ButtonsTemplate,
+    PostbackAction,
+    PushMessageRequest,
+    TemplateMessage,
+)
+
+import message_templates  # noqa: E402
+
+
+# 舊的做法：每次都重新建立
+def build_other_operation_options():
+    buttons_template = ButtonsTemplate(
+        title="請問你還需要處理其他項目嗎？",
+        text="請點擊以下選項",
+        actions=[
+            PostbackAction(label="生理監測", data="monitor"),
+            PostbackAction(label="AI衛教", data="educate"),
+            PostbackAction(label="運動", data="exercise"),
+            PostbackAction(label="登出", data="logout"),
+        ],
+    )
+    return TemplateMessage(
+        alt_text="請問你還需要處理其他項目嗎？", template=buttons_template
+    )
+
+
+def registry_other_operation_options():
+    return message_templates.OTHER_OPERATION_OPTIONS
+
+
+# 包含送出前轉成 JSON 的成本
+def with_request(build):
+    def run():
+        PushMessageRequest(to="U0", messages=[build()]).to_json()
+
+    return run
+
+
+def measure(name: str, func, number: int):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print(f"{name:<32} {seconds / number * 1e6:10.2f} us/event")
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    measure("build per event", build_other_operation_options, number)
+    measure("registry", registry_other_operation_options, number)
+    measure("build per event + request", with_request(build_other_operation_options), number)
+    measure("registry + request", with_request(registry_other_operation_options), number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+本機的假 LINE Messaging API 伺服器，測試時不用真的送訊息給使用者
+把環境變數 LINE_API_HOST 設成 http://127.0.0.1:<port> 就會改送到這裡
+
+支援 reply / push / multicast / 取得個人資料 / 取得 bot 資訊，
+可以加上固定延遲、隨機錯誤，以及每秒請求數上限 (超過時回 429)
+
+GET /stats 取得收到的請求數與收件人數，POST /stats/reset 歸零
+
+執行方式：python benchmarks/line_stub.py [--port 8090] [--latency 0.05] [--error-rate 0.01] [--rate-limit 100]
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.recipients = 0
+        self.messages = 0
+        self.rate_limited = 0
+        self.errors = 0
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "requests": dict(self.counts),
+                "recipients": self.recipients,
+                "messages": self.messages,
+                "rate_limited": self.rate_limited,
+                "errors": self.errors,
+            }
+
+
+class RateWindow:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.second = 0
+        self.count = 0
+
+    # 這一秒內的請求數是否超過上限
+    def allow(self) -> bool:
+        if self.limit <= 0:
+            return True
+        with self.lock:
+            now = int(time.monotonic())
+            if now != self.second:
+                self.second = now
+                self.count = 0
+            self.count += 1
+            return self.count <= self.limit
+
+
+def make_handler(stats: Stats, latency: float, error_rate: float, window: RateWindow):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status: int, body: dict, headers: dict = None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self) -> dict:
+            length = int(self.headers.get("Content-Length", 0))
+            if length <= 0:
+                return {}
+            return json.loads(self.rfile.read(length))
+
+        # 共用的延遲、錯誤與速率限制，回傳 True 表示已經回應錯誤
+        def _inject(self, name: str) -> bool:
+            with stats.lock:
+                stats.counts[name] = stats.counts.get(name, 0) + 1
+            if latency > 0:
+                time.sleep(latency)
+            if not window.allow():
+                with stats.lock:
+                    stats.rate_limited += 1
+                self._send(429, {"message": "The API rate limit has been exceeded."}, {"Retry-After": "1"})
+                return True
+            if error_rate > 0 and random.random() < error_rate:
+                with stats.lock:
+                    stats.errors += 1
+                self._send(500, {"message": "injected error"})
+                return True
+            return False
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, stats.to_dict())
+            elif self.path == "/v2/bot/info":
+                if self._inject("info"):
+                    return
+                self._send(
+                    200,
+                    {
+                        "userId": "Ustub",
+                        "basicId": "@stub",
+                        "displayName": "stub",
+                        "chatMode": "bot",
+                        "markAsReadMode": "auto",
+                    },
+                )
+            elif self.path.startswith("/v2/bot/profile/"):
+                if self._inject("profile"):
+                    return
+                user_id = self.path.rsplit("/", 1)[-1]
+                self._send(200, {"userId": user_id, "displayName": "stub"})
+            else:
+                self._send(404, {"message": "Not found"})
+
+        def do_POST(self):
+            if self.path == "/stats/reset":
+                with stats.lock:
+                    stats.reset()
+                self._send(200, {})
+                return
+
+            routes = {
+                "/v2/bot/message/reply": "reply",
+                "/v2/bot/message/push": "push",
+                "/v2/bot/message/multicast": "multicast",
+            }
+            name = routes.get(self.path)
+            if name is None:
+                self._send(404, {"message": "Not found"})
+                return
+
+            body = self._read_json()
+            if self._inject(name):
+                return
+            messages = body.get("messages", [])
+            to = body.get("to", [])
+            recipients = len(to) if isinstance(to, list) else 1
+            with stats.lock:
+                stats.recipients += recipients
+                stats.messages += len(messages) * recipients
+            self._send(200, {"sentMessages": [{"id": "0"} for _ in messages]})
+
+    return Handler
+
+
+# 在背景啟動，回傳 (server, stats)，測試程式結束時呼叫 server.shutdown()
+def serve(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, error_rate: float = 0.0, rate_limit: int = 0):
+    stats = Stats()
+    handler = make_handler(stats, latency, error_rate, RateWindow(rate_limit))
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="假的 LINE Messaging API 伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="每個請求的延遲秒數")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回 500 的比例")
+    parser.add_argument("--rate-limit", type=int, default=0, help="每秒請求數上限，0 為不限制")
+    args = parser.parse_args()
+
+    server, _ = serve(args.host, args.port, args.latency, args.error_rate, args.rate_limit)
+    print(f"LINE stub listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+"""
+端對端的壓力測試
+依照設定的使用者人數與流程比例產生有簽章的 LINE webhook 事件，
+一個使用者的事件依照順序送出，不同使用者同時進行，送到 main.py 的 linebot()
+
+流程：
+    register  新會員 → 姓名 → 身分證字號 → 電話 → 確認 (postback) → 登入
+    stamp     輸入「集點」
+    postback  monitor / educate / exercise 集點按鈕
+    follow    加入好友
+
+預設在同一個行程內用 Flask 的 test client 呼叫，並在本機啟動假的 LINE 伺服器
+(line_stub.py) 和集點後端 (backend_stub.py)，可以設定兩邊的延遲與錯誤比例。
+指定 --url 時改用 HTTP 送到已經在執行的伺服器，這時伺服器要自己設定
+LINE_API_HOST、BACKEND_URL 與相同的 SECRET
+
+結果包含 p50/p95/p99 延遲、每秒事件數與記憶體用量，
+存成 benchmarks/results/<commit>-<時間>.json，可以用 --compare 比較不同 commit 的結果
+
+執行方式：
+    python benchmarks/load_test.py [--users 200] [--events 2000] [--concurrency 8]
+        [--mix register=1,stamp=3,postback=3,follow=1]
+        [--line-latency 0.02] [--line-error-rate 0] [--backend-latency 0.05] [--backend-error-rate 0]
+        [--url http://127.0.0.1:5000/] [--output 檔名]
+    python benchmarks/load_test.py --compare 結果1.json 結果2.json ...
+"""
+
+import argparse
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import platform
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import backend_stub  # noqa: E402
+import line_stub  # noqa: E402
+
+STAMP_BUTTONS = ("monitor", "educate", "exercise")
+
+
+def id_number(index: int) -> str:
+    return f"A1{index:08d}"
+
+
+def tel(index: int) -> str:
+    return f"09{index:08d}"
+
+
+# 每個流程產生的事件 (種類, 內容)
+FLOWS = {
+    "register": lambda index, rng: [
+        ("text", "新會員"),
+        ("text", f"使用者{index}"),
+        ("text", id_number(index)),
+        ("text", tel(index)),
+        ("postback", "correct"),
+        ("text", id_number(index)),
+    ],
+    "stamp": lambda index, rng: [("text", "集點")],
+    "postback": lambda index, rng: [("postback", rng.choice(STAMP_BUTTONS))],
+    "follow": lambda index, rng: [("follow", None)],
+}
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in FLOWS:
+            raise ValueError(f"unknown flow: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def user_id_of(index: int) -> str:
+    return f"U{index:032x}"
+
+
+def make_event(kind: str, value, user_id: str, event_id: str) -> dict:
+    event = {
+        "type": kind if kind != "text" else "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": event_id,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+    }
+    if kind == "text":
+        event["message"] = {"type": "text", "id": event_id, "text": value, "quoteToken": "q"}
+    elif kind == "postback":
+        event["postback"] = {"data": value}
+    elif kind == "follow":
+        event["follow"] = {"isUnblocked": False}
+    return event
+
+
+def sign(secret: str, body: str) -> str:
+    digest = hmac.new(secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+# 依照流程比例產生每個使用者要送出的事件，簽章先算好，不算在延遲裡
+def build_plan(users: int, events: int, mix: dict, secret: str, seed: int) -> list:
+    rng = random.Random(seed)
+    # 每次執行的事件 ID 都不同，才不會被去重擋掉
+    run_id = uuid.uuid4().hex[:20]
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    steps = {index: [] for index in range(users)}
+    total = 0
+    while total < events:
+        index = rng.randrange(users)
+        flow = rng.choices(names, weights)[0]
+        for kind, value in FLOWS[flow](index, rng):
+            steps[index].append((flow, kind, value))
+            total += 1
+
+    plan = []
+    sequence = 0
+    for index, user_steps in steps.items():
+        if not user_steps:
+            continue
+        user_id = user_id_of(index)
+        session = []
+        for flow, kind, value in user_steps:
+            sequence += 1
+            event = make_event(kind, value, user_id, f"{run_id}{sequence:010d}")
+            body = json.dumps({"destination": "Uloadtest", "events": [event]}, ensure_ascii=False)
+            session.append((flow, body, sign(secret, body)))
+        plan.append(session)
+    return plan
+
+
+# 同一個行程內用 Flask test client 送出
+class InProcessSender:
+    def __init__(self):
+        import main
+
+        self.app = main.app
+        self.path = main.webhook
+        self.local = threading.local()
+
+    def post(self, body: str, signature: str) -> int:
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.post(
+            self.path,
+            data=body.encode("utf-8"),
+            headers={"X-Line-Signature": signature, "Content-Type": "application/json"},
+        )
+        return response.status_code
+
+
+# 用 HTTP 送到已經在執行的伺服器
+class HttpSender:
+    def __init__(self, url: str):
+        self.url = url
+        self.local = threading.local()
+
+    def post(self, body: str, signature: str) -> int:
+        import requests
+
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        response = session.post(
+            self.url,
+            data=body.encode("utf-8"),
+            headers={"X-Line-Signature": signature, "Content-Type": "application/json"},
+            timeout=30,
+        )
+        return response.status_code
+
+
+def run(sender, plan: list, concurrency: int):
+    sessions = queue.Queue()
+    for session in plan:
+        sessions.put(session)
+    samples = []
+    lock = threading.Lock()
+
+    def worker():
+        local = []
+        while True:
+            try:
+                session = sessions.get_nowait()
+            except queue.Empty:
+                break
+            for flow, body, signature in session:
+                start = time.perf_counter()
+                try:
+                    status = sender.post(body, signature)
+                except Exception:
+                    status = 0
+                local.append((flow, time.perf_counter() - start, status))
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def latency_summary(latencies: list) -> dict:
+    values = sorted(latency * 1000 for latency in latencies)
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": values[-1] if values else 0.0,
+    }
+
+
+# 目前與最高的記憶體用量 (MB)，只有 Linux 有 /proc
+def memory_usage() -> dict:
+    result = {}
+    try:
+        import resource
+
+        result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        result["rss_mb"] = pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        pass
+    return result
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=ROOT).returncode != 0
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    by_flow = {}
+    status = {}
+    for flow, latency, code in samples:
+        by_flow.setdefault(flow, []).append(latency)
+        status[str(code)] = status.get(str(code), 0) + 1
+    return {
+        "events": len(samples),
+        "elapsed_s": elapsed,
+        "events_per_s": len(samples) / elapsed if elapsed else 0.0,
+        "latency_ms": latency_summary([latency for _, latency, _ in samples]),
+        "by_flow": {flow: latency_summary(values) for flow, values in sorted(by_flow.items())},
+        "status": status,
+    }
+
+
+def print_result(result: dict):
+    latency = result["latency_ms"]
+    print(f"commit {result['commit']}，{result['events']} 個事件，{result['elapsed_s']:.2f} 秒")
+    print(f"每秒事件數: {result['events_per_s']:.1f}")
+    print(
+        f"延遲 (ms): p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  "
+        f"p99 {latency['p99']:.1f}  max {latency['max']:.1f}"
+    )
+    for flow, stat in result["by_flow"].items():
+        print(
+            f"  {flow:<10} {stat['count']:>6} 個  p50 {stat['p50']:.1f}  "
+            f"p95 {stat['p95']:.1f}  p99 {stat['p99']:.1f}"
+        )
+    print(f"回應狀態: {result['status']}")
+    if result.get("memory"):
+        memory = result["memory"]
+        print(
+            f"記憶體 (MB): 開始 {memory['before'].get('rss_mb', 0):.1f}  "
+            f"結束 {memory['after'].get('rss_mb', 0):.1f}  "
+            f"最高 {memory['after'].get('max_rss_mb', 0):.1f}"
+        )
+
+
+COMPARE_FIELDS = (
+    ("events/s", lambda r: r["events_per_s"], True),
+    ("p50 ms", lambda r: r["latency_ms"]["p50"], False),
+    ("p95 ms", lambda r: r["latency_ms"]["p95"], False),
+    ("p99 ms", lambda r: r["latency_ms"]["p99"], False),
+    ("max rss MB", lambda r: (r.get("memory") or {}).get("after", {}).get("max_rss_mb"), False),
+)
+
+
+# 以第一個結果為基準，列出其他結果的差異
+def compare(paths: list):
+    results = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            results.append(json.load(f))
+    base = results[0]
+    print(f"{'':<12}" + "".join(f"{r['commit']:>22}" for r in results))
+    for name, getter, higher_is_better in COMPARE_FIELDS:
+        base_value = getter(base)
+        cells = []
+        for result in results:
+            value = getter(result)
+            if value is None:
+                cells.append(f"{'-':>22}")
+                continue
+            cell = f"{value:.1f}"
+            if result is not base and base_value:
+                change = (value - base_value) / base_value * 100
+                better = change > 0 if higher_is_better else change < 0
+                cell += f" ({change:+.1f}%{' ✓' if better else ''})"
+            cells.append(f"{cell:>22}")
+        print(f"{name:<12}" + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LINE bot 端對端壓力測試")
+    parser.add_argument("--users", type=int, default=200, help="使用者人數")
+    parser.add_argument("--events", type=int, default=2000, help="大約要送出的事件數")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時送出的使用者數")
+    parser.add_argument("--mix", default="register=1,stamp=3,postback=3,follow=1", help="流程比例")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--line-latency", type=float, default=0.02)
+    parser.add_argument("--line-error-rate", type=float, default=0.0)
+    parser.add_argument("--backend-latency", type=float, default=0.05)
+    parser.add_argument("--backend-error-rate", type=float, default=0.0)
+    parser.add_argument("--url", help="送到已經在執行的伺服器，不啟動假的 LINE 與後端")
+    parser.add_argument("--secret", default=os.getenv("SECRET", "loadtest"), help="channel secret")
+    parser.add_argument("--rate-limit", action="store_true", help="啟用 webhook 的流量限制")
+    parser.add_argument("--output", help="結果檔案，預設存到 benchmarks/results/")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT", help="比較幾個結果檔案")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+        return
+
+    mix = parse_mix(args.mix)
+    line_server = backend_server = None
+    if args.url:
+        sender = HttpSender(args.url)
+    else:
+        line_server, line_stats = line_stub.serve(
+            latency=args.line_latency, error_rate=args.line_error_rate
+        )
+        backend_server, backend_stats = backend_stub.serve(
+            latency=args.backend_latency, error_rate=args.backend_error_rate
+        )
+        # 要在 import main 之前設定
+        os.environ["SECRET"] = args.secret
+        os.environ.setdefault("ACCESS_TOKEN", "loadtest")
+        os.environ["LINE_API_HOST"] = f"http://127.0.0.1:{line_server.server_address[1]}"
+        os.environ["BACKEND_URL"] = f"http://127.0.0.1:{backend_server.server_address[1]}"
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        os.environ.setdefault("LOG_BODY_SAMPLE_RATE", "0")
+        os.environ.setdefault("WARMUP_ENABLED", "false")
+        # 測試時每個使用者會連續送出很多事件，加上 --rate-limit 才啟用限制
+        os.environ["RATE_LIMIT_ENABLED"] = "true" if args.rate_limit else "false"
+
+        import main as bot
+        import persistence as db
+
+        db.init_db()
+        bot.load_health_info(os.path.join(ROOT, "bot_health_info.json"))
+        sender = InProcessSender()
+
+    plan = build_plan(args.users, args.events, mix, args.secret, args.seed)
+    memory_before = memory_usage()
+    samples, elapsed = run(sender, plan, args.concurrency)
+    memory_after = memory_usage()
+
+    result = {
+        "commit": git_commit(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "mode": "http" if args.url else "in-process",
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ("compare", "secret")
+        },
+        **summarize(samples, elapsed),
+    }
+    if not args.url:
+        # --url 時伺服器在別的行程，這裡量到的記憶體沒有意義
+        result["memory"] = {"before": memory_before, "after": memory_after}
+        result["line_stub"] = line_stats.to_dict()
+        result["backend_stub"] = backend_stats.to_dict()
+        line_server.shutdown()
+        backend_server.shutdown()
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{result['commit']}-{stamp}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print_result(result)
+    print(f"結果已存到 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+對話流程中和 I/O 無關的部分
+狀態怎麼變、回覆哪一段文字、訊息怎麼組合都在這裡決定，
+main.py (同步) 和 asgi_app.py (async) 只負責讀寫資料庫、呼叫集點後端與 LINE，
+流程要修改時只改這裡，兩邊的行為就會一致
+
+會改變使用者狀態的函式直接修改傳入的 user_info，由呼叫的一方存回資料庫
+後端的回應用 status_code 與 json() 判斷，requests 和 async 的回應都可以直接傳進來
+
+"""
+
+import re
+
+from linebot.v3.messaging import (
+    ButtonsTemplate,
+    FlexMessage,
+    PostbackAction,
+    TemplateMessage,
+    TextMessage,
+)
+
+import flex_templates
+import membership
+import message_templates
+
+CONTACT_ADMIN = "請聯絡管理員"
+STAMP_FAILED = "集點失敗！請稍後嘗試!"
+LINK_FORMAT_ERROR = "身分證字號格式錯誤，請輸入有效的身分證字號（1個字母 + 9個數字）"
+LOGIN_FORMAT_ERROR = "登入步驟錯誤或身分證字號格式錯誤"
+
+# 「集點」訊息使用的集點項目與上限
+STAMP_MESSAGE = ("healthMeasurement", "集點券", 15)
+
+# 集點類的 postback：(集點項目, 進度條標題, 上限, 只在成功時附上選單)
+STAMP_POSTBACKS = {
+    "monitor": ("healthMeasurement", "量血壓次數", 15, True),
+    "educate": ("healthEducation", "AI衛教次數", 2, False),
+    "exercise": ("exercise", "運動次數", 6, False),
+}
+
+
+def createUserInfo(userid: str):
+    info = {
+        "user_id": userid,
+        "name": None,
+        "idNumber": None,
+        "tel": None,
+        "steptype": None,
+        "step": 0,
+        "errcount": 0,
+        "register": False,
+    }
+    return info
+
+
+# 檢查身分證字號格式
+def check_id_number(idNumber) -> bool:
+    return re.match(r"^[A-Za-z]\d{9}$", idNumber)
+
+
+# 檢查電話號碼格式
+def check_tel(tel) -> bool:
+    return re.match(r"\d{10}", tel)
+
+
+# 建立操作提示選項
+def create_operation_options():
+    return message_templates.OPERATION_OPTIONS
+
+
+def text_reply(text: str) -> list:
+    return [TextMessage(text=text)]
+
+
+# 流程結束，清掉步驟
+def reset_steps(user_info):
+    user_info["steptype"] = None
+    user_info["step"] = 0  # 重設步驟為0
+    user_info["errcount"] = 0
+
+
+# 輸入格式錯誤，記錄錯誤次數
+def input_error(user_info, reply_text: str) -> list:
+    user_info["errcount"] += 1
+    return text_reply(reply_text)
+
+
+def start_register(user_info) -> list:
+    user_info["step"] = 1
+    user_info["steptype"] = "新會員"
+    return text_reply("請輸入姓名")
+
+
+def start_link(user_info) -> list:
+    user_info["step"] = 1
+    user_info["steptype"] = "連結LINEID"
+    return text_reply("請輸入身分證字號")
+
+
+def register_name(user_info, message: str) -> list:
+    user_info["step"] = 2
+    user_info["name"] = message
+    return text_reply("請輸入身分證字號")
+
+
+def register_id_number(user_info, message: str) -> list:
+    if not check_id_number(message):
+        return input_error(user_info, "格式錯誤！請輸入 1 個英文字母和 9 個數字。")
+    user_info["idNumber"] = message
+    user_info["step"] = 3
+    return text_reply("請輸入電話號碼")
+
+
+# 記下電話號碼，請使用者確認資料
+def register_tel(user_info, message: str) -> list:
+    user_info["tel"] = message
+    user_info["step"] = 4
+    buttons_template = ButtonsTemplate(
+        title="請確認您的資料",
+        text=(
+            f"您的姓名是 {user_info['name']}、\n"
+            f"身份證字號是 {user_info['idNumber']}、\n"
+            f"電話是 {user_info['tel']}。\n請問是否正確？"
+        ),
+        actions=[
+            PostbackAction(label="是", data="correct"),
+            PostbackAction(label="否", data="incorrect"),
+        ],
+    )
+    return [TemplateMessage(alt_text="確認資料", template=buttons_template)]
+
+
+# 資料有誤，從姓名重新開始，回傳 (新的使用者資料, 訊息)
+def restart_register(user_id: str) -> tuple[dict, list]:
+    user_info = createUserInfo(user_id)
+    user_info["steptype"] = "新會員"
+    user_info["step"] = 1
+    return user_info, text_reply("請重新輸入姓名")
+
+
+# 送到 /add_user/ 的會員資料
+def member_data(user_info) -> dict:
+    return {
+        "name": user_info["name"],
+        "idNumber": user_info["idNumber"],
+        "tel": user_info["tel"],
+    }
+
+
+# 註冊的結果，成功時標記為已註冊
+def register_result(user_info, status_code: int) -> list:
+    if status_code != 200:
+        return text_reply("註冊失敗！請稍後嘗試!")
+    user_info["register"] = True
+    membership.invalidate_id_number(user_info["idNumber"])
+    return text_reply("註冊完成！請輸入身分證字號登入")
+
+
+# 連結成功後，清掉兩邊的會員快取
+def linked(line_id: str, id_number: str):
+    membership.invalidate_line_id(line_id)
+    membership.invalidate_id_number(id_number)
+
+
+# 連結 LINE ID 的結果，response 為 None 表示請求失敗，不論結果都結束流程
+def link_result(user_info, id_number: str, response) -> list:
+    # 先看狀態碼，錯誤頁面不一定是 JSON
+    if response is None:
+        reply_text = CONTACT_ADMIN
+    elif response.status_code == 200:
+        reply_text = "連結成功"
+        linked(user_info["user_id"], id_number)
+    elif response.status_code == 400:
+        try:
+            reply_text = response.json().get("detail") or CONTACT_ADMIN
+        except (ValueError, AttributeError):
+            reply_text = CONTACT_ADMIN
+    else:
+        reply_text = "重複連結或錯誤，請確認!"
+    reset_steps(user_info)
+    return text_reply(reply_text)
+
+
+# 登入時查詢身分證字號的結果，已註冊就結束流程並送出操作選項
+def login_result(user_info, registered: bool) -> list:
+    if not registered:
+        return text_reply("請註冊!!")
+    reset_steps(user_info)
+    return [create_operation_options()]
+
+
+def logout_result(user_info, status_code: int) -> list:
+    if status_code != 200:
+        return text_reply("請重試")
+    membership.invalidate_line_id(user_info["user_id"])
+    return text_reply("登出成功")
+
+
+def progress(title: str, msg: str, count: int, max_count: int) -> FlexMessage:
+    flex = flex_templates.progress_bar_container(title, msg, count, max_count)
+    return FlexMessage(alt_text="hello", contents=flex)
+
+
+# 「集點」訊息的回覆
+def stamp_reply(result) -> list:
+    if not result.ok:
+        return text_reply(STAMP_FAILED)
+    _, title, max_count = STAMP_MESSAGE
+    count = result.count
+    if count < max_count:
+        reply_text = "集點成功，加油!!"
+    elif count == max_count:
+        reply_text = "集滿囉!!!可以拿給志工確認換禮物囉~"
+    else:
+        reply_text = "有持續量血壓很棒喔~"
+    return [progress(title, "目前集點進度", count, max_count), TextMessage(text=reply_text)]
+
+
+# 集點 postback 的回覆，加進 outgoing
+def add_stamp_postback_reply(outgoing, data: str, result):
+    _, title, max_count, options_on_success_only = STAMP_POSTBACKS[data]
+    if result.ok:
+        outgoing.add(
+            progress(title, "目前集點進度", result.count, max_count),
+            TextMessage(text="集點完成"),
+        )
+        outgoing.add(message_templates.OTHER_OPERATION_OPTIONS)
+    else:
+        outgoing.add(TextMessage(text=STAMP_FAILED))
+        if not options_on_success_only:
+            outgoing.add(message_templates.OTHER_OPERATION_OPTIONS)
+
+
+# 先用預估的點數回覆後，後端確認的點數不同時補送的更正
+def correction(title: str, max_count: int, result) -> list:
+    if result.ok:
+        return [progress(title, "點數已更新", result.count, max_count)]
+    return text_reply(STAMP_FAILED)
+
+
+# 加入好友時的歡迎訊息
+def welcome(profile) -> list:
+    welcometitle = "您好！歡迎使用健康小幫手，您看起來還不是我們會員，請選擇新會員或其他以獲得服務。"
+    if profile.display_name:
+        welcometitle = profile.display_name + welcometitle
+    return [TextMessage(text=welcometitle), message_templates.WELCOME_MENU]
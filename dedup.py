@@ -0,0 +1,131 @@
+"""
+webhook 事件去重
+webhook 回應太慢時 LINE 會重送事件 (deliveryContext.isRedelivery 為 true)，
+重送的集點事件如果再處理一次，就會多集一點、多推送一次訊息
+
+用 webhookEventId 記住最近 DEDUP_WINDOW 秒內處理過的事件 (最多 DEDUP_MAX_SIZE 個)，
+看過的事件在交給 handler 之前就直接丟掉
+
+DEDUP_SHARED 為 true 時也會記錄到 persistence 的儲存後端 (mongo / sqlite)，
+多個行程之間也能擋掉重送的事件。只有重送的事件才會因為共用的紀錄被丟掉，
+第一次送來的事件一定會處理
+
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+import persistence as db
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+def event_id_of(event):
+    return getattr(event, "webhook_event_id", None)
+
+
+def is_redelivery(event) -> bool:
+    context = getattr(event, "delivery_context", None)
+    return bool(getattr(context, "is_redelivery", False))
+
+
+class EventDeduplicator:
+    def __init__(self, window: float = 3600, max_size: int = 100000, shared: bool = False):
+        self.window = window
+        self.max_size = max_size
+        self.shared = shared
+        self.lock = threading.Lock()
+        # webhookEventId -> 看到的時間，依照時間順序排列
+        self.seen_at = OrderedDict()
+
+        # 統計資料
+        self.events = 0
+        self.redeliveries = 0
+        self.suppressed = 0
+        self.suppressed_shared = 0
+        self.shared_errors = 0
+
+    # 移除超過時間或超過上限的紀錄，呼叫時必須持有 lock
+    def _expire(self, now: float):
+        seen_at = self.seen_at
+        while seen_at:
+            seen = next(iter(seen_at.values()))
+            if now - seen < self.window and len(seen_at) <= self.max_size:
+                break
+            seen_at.popitem(last=False)
+
+    # 這個行程內是否已經看過，沒看過就記下來
+    def seen_locally(self, event) -> bool:
+        event_id = event_id_of(event)
+        if not event_id:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self.events += 1
+            if is_redelivery(event):
+                self.redeliveries += 1
+            self._expire(now)
+            if event_id in self.seen_at:
+                self.suppressed += 1
+                return True
+            self.seen_at[event_id] = now
+            return False
+
+    # 查詢並記錄到共用的儲存，只有重送的事件會因為已經有紀錄被丟掉
+    # 儲存後端有問題時一律當作沒看過，寧可多處理也不要漏掉事件
+    def seen_shared(self, event) -> bool:
+        event_id = event_id_of(event)
+        if not self.shared or not event_id:
+            return False
+        try:
+            first = db.mark_event(event_id, self.window)
+        except Exception as e:
+            logger.error(f"Error while marking event: {e}")
+            with self.lock:
+                self.shared_errors += 1
+            return False
+        if first or not is_redelivery(event):
+            return False
+        with self.lock:
+            self.suppressed_shared += 1
+        return True
+
+    # 已經處理過的事件回傳 True，呼叫的地方應該直接丟掉
+    def seen(self, event) -> bool:
+        return self.seen_locally(event) or self.seen_shared(event)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "shared": self.shared,
+                "window": self.window,
+                "entries": len(self.seen_at),
+                "events": self.events,
+                "redeliveries": self.redeliveries,
+                "suppressed": self.suppressed + self.suppressed_shared,
+                "suppressed_local": self.suppressed,
+                "suppressed_shared": self.suppressed_shared,
+                "shared_errors": self.shared_errors,
+            }
+
+
+deduplicator = EventDeduplicator(
+    window=float(os.getenv("DEDUP_WINDOW", 3600)),
+    max_size=int(os.getenv("DEDUP_MAX_SIZE", 100000)),
+    shared=os.getenv("DEDUP_SHARED", "false").lower() == "true",
+)
+
+
+def seen(event) -> bool:
+    return deduplicator.seen(event)
+
+
+def stats() -> dict:
+    return deduplicator.stats()
@@ -0,0 +1,147 @@
+"""
+webhook 事件的背景處理模組
+簽章驗證在 request 裡同步完成，解析好的事件放進有上限的佇列，
+由背景 worker 取出處理，webhook 就能馬上回 200 給 LINE
+
+事件會依照 user_id 分配到固定的 worker，同一個使用者的事件依序處理，
+不同使用者的事件則可以同時處理，避免 user_info 的讀取-修改-寫入互相覆蓋
+
+佇列滿了不會等待，也不會改在 request 裡處理 (會和 worker 中同一個使用者的事件同時執行)，
+直接放棄這個事件並記在 rejected
+
+環境變數 EVENT_WORKERS 為 0 (預設) 時不啟用，維持原本同步處理的方式
+
+"""
+
+import itertools
+import logging
+import queue
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class EventWorkerPool:
+    def __init__(
+        self,
+        handle_func,
+        workers: int = 4,
+        maxsize: int = 1000,
+    ):
+        self.handle_func = handle_func
+        self.workers = max(1, workers)
+        # 每個 worker 一個佇列，總容量平均分配
+        shard_size = max(1, maxsize // self.workers)
+        self.shards = [queue.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        self.round_robin = itertools.count()
+        self.threads = []
+        self.started_at = None
+        self.lock = threading.Lock()
+
+        # 統計資料
+        self.submitted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.busy_time = [0.0] * self.workers
+
+    # 啟動 worker
+    def start(self):
+        if self.threads:
+            return
+        self.started_at = time.monotonic()
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, args=(index,), name=f"event-worker-{index}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    # 停止 worker，會先把佇列中的事件處理完
+    def stop(self, timeout: float = 5.0):
+        for shard in self.shards:
+            shard.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    # 依照事件來源決定要交給哪個 worker
+    def shard_of(self, event) -> int:
+        source = getattr(event, "source", None)
+        key = (
+            getattr(source, "user_id", None)
+            or getattr(source, "group_id", None)
+            or getattr(source, "room_id", None)
+        )
+        if key is None:
+            return next(self.round_robin) % self.workers
+        return zlib.crc32(key.encode()) % self.workers
+
+    # 放入事件，不會等待，佇列滿了就回傳 False
+    def submit(self, event) -> bool:
+        shard = self.shards[self.shard_of(event)]
+        try:
+            shard.put_nowait((time.monotonic(), event))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.submitted += 1
+        return True
+
+    def _run(self, index: int):
+        events = self.shards[index]
+        while True:
+            item = events.get()
+            if item is None:
+                events.task_done()
+                return
+
+            queued_at, event = item
+            start = time.monotonic()
+            waited = start - queued_at
+            try:
+                self.handle_func(event)
+                failed = False
+            except Exception as e:
+                logger.exception(f"Error while handling event: {e}")
+                failed = True
+            finally:
+                events.task_done()
+
+            with self.lock:
+                self.busy_time[index] += time.monotonic() - start
+                self.processed += 1
+                if failed:
+                    self.failed += 1
+                self.wait_total += waited
+                if waited > self.wait_max:
+                    self.wait_max = waited
+
+    # 佇列深度、排隊時間、每個 worker 的使用率
+    def stats(self) -> dict:
+        with self.lock:
+            uptime = time.monotonic() - self.started_at if self.started_at else 0.0
+            return {
+                "workers": self.workers,
+                "queue_depth": sum(shard.qsize() for shard in self.shards),
+                "queue_size": sum(shard.maxsize for shard in self.shards),
+                "shard_depth": [shard.qsize() for shard in self.shards],
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "failed": self.failed,
+                "queue_wait_avg_ms": (
+                    self.wait_total / self.processed * 1000 if self.processed else 0.0
+                ),
+                "queue_wait_max_ms": self.wait_max * 1000,
+                "utilisation": [
+                    round(busy / uptime, 4) if uptime > 0 else 0.0
+                    for busy in self.busy_time
+                ],
+            }
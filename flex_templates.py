@@ -0,0 +1,159 @@
+"""
+Flex Message 的樣板
+版面在程式啟動時只解析、驗證一次，之後只替換會變動的欄位 (標題、訊息、進度文字、進度條寬度)，
+不用每次都重建整個 dict 再讓 FlexContainer.from_dict 驗證一遍
+
+進度條的結果會依照 (標題, 訊息, 目前次數, 上限) 快取起來，集點的組合有限，
+大部分的回覆都可以直接用快取的結果
+
+"""
+
+import os
+from functools import lru_cache
+
+from dotenv import load_dotenv
+from linebot.v3.messaging import FlexContainer
+
+load_dotenv()
+
+CACHE_SIZE = int(os.getenv("FLEX_CACHE_SIZE", 512))
+
+
+class FlexTemplate:
+    def __init__(self, layout: dict, slots: dict):
+        self.layout = layout
+        # 欄位名稱 -> 在版面中的路徑
+        self.slots = slots
+        # 驗證一次，之後都從這份複製
+        self.prototype = FlexContainer.from_dict(layout)
+
+    # 只複製路徑上經過的節點，其他部分和樣板共用
+    @staticmethod
+    def _replace(node, path, value):
+        if not path:
+            return value
+        key = path[0]
+        if isinstance(key, int):
+            items = list(node)
+            items[key] = FlexTemplate._replace(items[key], path[1:], value)
+            return items
+        new_node = node.copy()
+        setattr(new_node, key, FlexTemplate._replace(getattr(node, key), path[1:], value))
+        return new_node
+
+    # 填入欄位，回傳可以直接放進 FlexMessage 的 FlexContainer
+    def render(self, **values) -> FlexContainer:
+        container = self.prototype
+        for name, value in values.items():
+            container = self._replace(container, self.slots[name], value)
+        return container
+
+
+PROGRESS_BAR_LAYOUT = {
+    "type": "carousel",
+    "contents": [
+        {
+            "type": "bubble",
+            "size": "kilo",
+            "header": {
+                "type": "box",
+                "layout": "vertical",
+                "backgroundColor": "#27ACB2",
+                "paddingTop": "19px",
+                "paddingAll": "12px",
+                "paddingBottom": "16px",
+                "contents": [
+                    {
+                        "type": "text",
+                        "text": "title",
+                        "color": "#FFFFFF",
+                        "size": "md",
+                        "align": "start",
+                        "gravity": "center",
+                    },
+                    {
+                        "type": "text",
+                        "text": "0/0",
+                        "color": "#ffffff",
+                        "align": "start",
+                        "size": "xs",
+                        "gravity": "center",
+                        "margin": "lg",
+                    },
+                    {
+                        "type": "box",
+                        "layout": "vertical",
+                        "contents": [
+                            {
+                                "type": "box",
+                                "layout": "vertical",
+                                "contents": [{"type": "filler"}],
+                                "width": "0%",
+                                "backgroundColor": "#0D8186",
+                                "height": "8px",
+                            }
+                        ],
+                        "backgroundColor": "#9FD8E3A0",
+                        "height": "8px",
+                        "margin": "sm",
+                    },
+                ],
+            },
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "flex": 1,
+                "contents": [
+                    {
+                        "type": "text",
+                        "text": "msg",
+                        "color": "#8C8C8C",
+                        "size": "sm",
+                        "wrap": True,
+                    }
+                ],
+            },
+            "styles": {"footer": {"separator": False}},
+        }
+    ],
+}
+
+progress_bar_template = FlexTemplate(
+    PROGRESS_BAR_LAYOUT,
+    {
+        "title": ("contents", 0, "header", "contents", 0, "text"),
+        "label": ("contents", 0, "header", "contents", 1, "text"),
+        "width": ("contents", 0, "header", "contents", 2, "contents", 0, "width"),
+        "msg": ("contents", 0, "body", "contents", 0, "text"),
+    },
+)
+
+
+def _progress_values(title: str, msg: str, current: int, max: int) -> dict:
+    # 計算進度條的長度
+    progress = int(float(current) / float(max) * 100)
+    if progress > 100:
+        progress = 100
+    return {
+        "title": title,
+        "label": str(current) + "/" + str(max),
+        "width": str(progress) + "%",
+        "msg": msg,
+    }
+
+
+# 產生進度條，回傳 FlexContainer，相同的參數會直接用快取
+# 回傳的物件會被共用，不可以修改
+@lru_cache(maxsize=CACHE_SIZE)
+def progress_bar_container(title: str, msg: str, current: int, max: int) -> FlexContainer:
+    return progress_bar_template.render(**_progress_values(title, msg, current, max))
+
+
+def cache_stats() -> dict:
+    info = progress_bar_container.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "max_size": info.maxsize,
+    }
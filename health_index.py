@@ -0,0 +1,125 @@
+"""
+健康資訊的關鍵字索引
+程式啟動時把 bot_health_info.json 的關鍵字和同義詞建成 Aho–Corasick 自動機，
+訊息中只要包含任何一個關鍵字就能找到對應的衛教內容，
+查詢時間只跟訊息長度有關，關鍵字增加到上千個也不會變慢
+
+bot_health_info.json 的格式：
+    "關鍵字": "回覆內容"
+    "關鍵字": {"answer": "回覆內容", "synonyms": ["同義詞", ...]}
+
+"""
+
+import unicodedata
+from collections import deque
+
+
+# 全形轉半形、英文不分大小寫
+def normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+class AhoCorasick:
+    def __init__(self):
+        # 每個節點：子節點、失敗連結、在這個節點結束的關鍵字 (長度, 值)
+        self.children = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        self.built = False
+
+    def add(self, pattern: str, value):
+        if not pattern:
+            return
+        node = 0
+        for char in pattern:
+            next_node = self.children[node].get(char)
+            if next_node is None:
+                next_node = len(self.children)
+                self.children.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.children[node][char] = next_node
+            node = next_node
+        self.outputs[node].append((len(pattern), value))
+        self.built = False
+
+    # 用 BFS 建立失敗連結，並把失敗連結上的關鍵字合併進來
+    def build(self):
+        queue = deque(self.children[0].values())
+        for node in queue:
+            self.fail[node] = 0
+        while queue:
+            node = queue.popleft()
+            for char, child in self.children[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.children[fail]:
+                    fail = self.fail[fail]
+                target = self.children[fail].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+                queue.append(child)
+        self.built = True
+
+    # 找出文字中所有的關鍵字，回傳 (開始位置, 長度, 值)
+    def find_all(self, text: str) -> list:
+        if not self.built:
+            self.build()
+        children = self.children
+        fail = self.fail
+        outputs = self.outputs
+        found = []
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in children[node]:
+                node = fail[node]
+            node = children[node].get(char, 0)
+            for length, value in outputs[node]:
+                found.append((index - length + 1, length, value))
+        return found
+
+
+class HealthIndex:
+    def __init__(self):
+        self.automaton = AhoCorasick()
+        # 關鍵字 -> 回覆內容
+        self.answers = {}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HealthIndex":
+        index = cls()
+        for key, entry in data.items():
+            if isinstance(entry, dict):
+                index.add(key, entry["answer"], entry.get("synonyms", []))
+            else:
+                index.add(key, entry)
+        index.automaton.build()
+        return index
+
+    def add(self, key: str, answer: str, synonyms: list = ()):
+        self.answers[key] = answer
+        for word in (key, *synonyms):
+            self.automaton.add(normalize(word), key)
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    # 訊息中提到的關鍵字，依照出現順序，重疊時取比較長的，同一個項目只回傳一次
+    def match(self, message: str, limit: int = 3) -> list:
+        if not message:
+            return []
+        found = self.automaton.find_all(normalize(message))
+        found.sort(key=lambda item: (item[0], -item[1]))
+        keys = []
+        end = 0
+        for start, length, key in found:
+            if start < end:
+                continue
+            end = start + length
+            if key not in keys:
+                keys.append(key)
+                if len(keys) >= limit:
+                    break
+        return keys
+
+    def lookup(self, message: str, limit: int = 3) -> list:
+        return [self.answers[key] for key in self.match(message, limit)]
@@ -0,0 +1,105 @@
+"""
+共用的 LINE Messaging API 用戶端
+整個程式只建立一個 ApiClient，第一次用到時才建立，
+所有事件共用同一個連線池，不用每次回覆都重新連線到 LINE
+
+asgi_app 使用 get_async_api 取得 async 版本的用戶端
+
+"""
+
+import atexit
+import os
+import threading
+
+from dotenv import load_dotenv
+from linebot.v3.messaging import (
+    ApiClient,
+    AsyncApiClient,
+    AsyncMessagingApi,
+    Configuration,
+    MessagingApi,
+)
+
+load_dotenv()
+
+POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", 10))
+
+_api_client = None
+_messaging_api = None
+_async_api_client = None
+_async_messaging_api = None
+_lock = threading.Lock()
+
+
+# LINE_API_HOST 可以指到本機的假 LINE 伺服器 (benchmarks/line_stub.py) 測試
+def create_configuration() -> Configuration:
+    host = os.getenv("LINE_API_HOST")
+    if host:
+        configuration = Configuration(host=host, access_token=os.getenv("ACCESS_TOKEN"))
+    else:
+        configuration = Configuration(access_token=os.getenv("ACCESS_TOKEN"))
+    configuration.connection_pool_maxsize = POOL_SIZE
+    return configuration
+
+
+# 取得共用的 MessagingApi，urllib3 的連線池可以跨執行緒使用
+def get_api() -> MessagingApi:
+    global _api_client, _messaging_api
+    if _messaging_api is None:
+        with _lock:
+            if _messaging_api is None:
+                _api_client = ApiClient(create_configuration())
+                _messaging_api = MessagingApi(_api_client)
+    return _messaging_api
+
+
+# 取得共用的 AsyncMessagingApi，aiohttp 的 session 必須在 event loop 裡建立
+def get_async_api() -> AsyncMessagingApi:
+    global _async_api_client, _async_messaging_api
+    if _async_messaging_api is None:
+        _async_api_client = AsyncApiClient(create_configuration())
+        _async_messaging_api = AsyncMessagingApi(_async_api_client)
+    return _async_messaging_api
+
+
+async def aclose():
+    global _async_api_client, _async_messaging_api
+    if _async_api_client is not None:
+        await _async_api_client.close()
+        _async_api_client = None
+        _async_messaging_api = None
+
+
+# 程式結束時關閉連線池
+def close():
+    global _api_client, _messaging_api
+    with _lock:
+        if _api_client is not None:
+            _api_client.close()
+            _api_client.rest_client.pool_manager.clear()
+            _api_client = None
+            _messaging_api = None
+
+
+atexit.register(close)
+
+
+# 連線使用狀況，reused 越高表示越少重新握手
+def connection_stats() -> dict:
+    requests_count = 0
+    new_connections = 0
+    with _lock:
+        if _api_client is not None:
+            pools = _api_client.rest_client.pool_manager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_count += pool.num_requests
+                new_connections += pool.num_connections
+    return {
+        "pool_size": POOL_SIZE,
+        "requests": requests_count,
+        "new_connections": new_connections,
+        "reused": max(0, requests_count - new_connections),
+    }
@@ -0,0 +1,194 @@
+"""
+結構化的 log
+handler 只把 log 放進佇列，由背景執行緒轉成 JSON 寫出去，
+不會在處理 webhook 的執行緒上做格式化與 I/O，佇列滿了就丟掉並記錄丟掉的數量
+
+寫出去之前會：
+    把 LOG_REDACT_FIELDS 列出的欄位 (預設 idNumber、tel) 換成 ***
+    把字串中看起來像身分證字號或手機號碼的部分遮掉 (LOG_REDACT_VALUES)
+    太長的字串只保留前 LOG_MAX_FIELD_LENGTH 個字
+
+webhook 的原始內容只會依照 LOG_BODY_SAMPLE_RATE 的比例抽樣記錄
+
+環境變數：
+    LOG_LEVEL             預設 INFO
+    LOG_FORMAT            json (預設) 或 text
+    LOG_QUEUE_SIZE        佇列大小
+    LOG_BODY_SAMPLE_RATE  0 ~ 1，0 表示不記錄 webhook 的內容
+
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+BODY_SAMPLE_RATE = float(os.getenv("LOG_BODY_SAMPLE_RATE", 0.01))
+MAX_FIELD_LENGTH = int(os.getenv("LOG_MAX_FIELD_LENGTH", 512))
+REDACT_FIELDS = frozenset(
+    field.strip()
+    for field in os.getenv("LOG_REDACT_FIELDS", "idNumber,tel").split(",")
+    if field.strip()
+)
+REDACT_VALUES = os.getenv("LOG_REDACT_VALUES", "true").lower() == "true"
+
+MASK = "***"
+
+# 身分證字號、手機號碼或 10 碼的電話號碼
+SENSITIVE = re.compile(r"(?<![A-Za-z0-9])(?:[A-Za-z]\d{9}|\d{10})(?![A-Za-z0-9])")
+
+# LogRecord 本身的屬性，其他的屬性都是用 extra 傳進來的欄位
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+def redact(value, key: str = None, max_length: int = MAX_FIELD_LENGTH):
+    if key in REDACT_FIELDS:
+        return None if value is None else MASK
+    if isinstance(value, dict):
+        return {k: redact(v, k, max_length) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v, None, max_length) for v in value]
+    if isinstance(value, str):
+        # 先遮再截斷，截在號碼中間時前半段才不會因為比對不到而留下來
+        length = len(value)
+        if REDACT_VALUES:
+            value = SENSITIVE.sub(MASK, value)
+        if max_length and length > max_length:
+            value = f"{value[:max_length]}...({length} chars)"
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                data[key] = value
+        data = redact(data)
+        # 錯誤的 traceback 不截斷
+        exc = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if exc:
+            data["exc"] = redact(exc, max_length=0)
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record) -> str:
+        text = super().format(record)
+        extra = {
+            key: value
+            for key, value in record.__dict__.items()
+            if key not in _RESERVED and not key.startswith("_")
+        }
+        if extra:
+            text += " " + json.dumps(redact(extra), ensure_ascii=False, default=str)
+        return redact(text, max_length=0)
+
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    # 只先組好訊息、複製 extra 的 dict (之後可能會被修改)，格式化交給背景執行緒
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        for key, value in record.__dict__.items():
+            if isinstance(value, dict) and key not in _RESERVED:
+                record.__dict__[key] = dict(value)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+
+_queue_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+def create_formatter() -> logging.Formatter:
+    return TextFormatter() if FORMAT == "text" else JsonFormatter()
+
+
+# 設定 root logger，重複呼叫不會重複設定
+def setup():
+    global _queue_handler, _listener
+    with _lock:
+        if _listener is not None:
+            return
+        log_queue = queue.Queue(QUEUE_SIZE)
+        _queue_handler = DroppingQueueHandler(log_queue)
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(create_formatter())
+        _listener = QueueListener(log_queue, output, respect_handler_level=False)
+        _listener.start()
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(_queue_handler)
+        root.setLevel(LEVEL)
+
+
+def stop():
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(stop)
+
+
+# 依照 LOG_BODY_SAMPLE_RATE 決定這次要不要記錄 webhook 的內容
+def sample_body() -> bool:
+    return BODY_SAMPLE_RATE > 0 and random.random() < BODY_SAMPLE_RATE
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+def stats() -> dict:
+    if _queue_handler is None:
+        return {"enabled": False}
+    return {
+        "enabled": True,
+        "format": FORMAT,
+        "level": LEVEL,
+        "queued": _queue_handler.queue.qsize(),
+        "dropped": _queue_handler.dropped,
+        "body_sample_rate": BODY_SAMPLE_RATE,
+    }
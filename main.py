@@ -1,20 +1,7 @@
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
-    MessageAction,
-    TextMessage,
-    FlexMessage,
-    FlexContainer,
-    TemplateMessage,
-    ButtonsTemplate,
-    PostbackAction,
-    PushMessageRequest,
-)
+from linebot.v3.messaging import TextMessage
 
 from linebot.v3.webhooks import (
     MessageEvent,
@@ -26,17 +13,46 @@ from linebot.v3.webhooks import (
 
 
 from linebot.exceptions import LineBotApiError
-import re
-import requests
 from dotenv import load_dotenv
 import os
 import json
 import random
+from concurrent.futures import ThreadPoolExecutor
 import persistence as db
+import backend_client as backend
+import line_client
+import flex_templates
+import message_templates
+import conversation
+from conversation import (
+    STAMP_POSTBACKS,
+    createUserInfo,
+    check_id_number,
+    create_operation_options,
+)
+from outgoing import OutgoingMessages
+import outgoing
+import push_pipeline
+import stamp_client
+import membership
+import warmup
+import dedup
+import ratelimit
+import metrics
+import logs
+from router import Router
+from health_index import HealthIndex
+from event_worker import EventWorkerPool
 
 from flask_cors import CORS
 
 health_info = None
+health_index = HealthIndex()
+# 一則訊息最多回覆幾筆健康資訊
+HEALTH_MAX_ANSWERS = int(os.getenv("HEALTH_MAX_ANSWERS", 3))
+
+# 要在第一次用到 app.logger 之前設定，Flask 才不會另外加上預設的 handler
+logs.setup()
 
 app = Flask(__name__)
 CORS(app)
@@ -57,155 +73,29 @@ user_info = {
     "register": False,
 }
 
-access_token = os.getenv("ACCESS_TOKEN")
 secret = os.getenv("SECRET")
 
-configuration = Configuration(access_token=access_token)
 handler = WebhookHandler(secret)
 
-BASE_URL = "https://linebotapi-tgkg.onrender.com"
-
-def build_url(path: str) -> str:
-    return f"{BASE_URL}{path}"
-
-# 建立操作提示選項
-def create_operation_options():
-    buttons_template = ButtonsTemplate(
-        title="請問你要進行什麼操作？",
-        text="請點擊以下選項",
-        actions=[
-            PostbackAction(label="開始集點", data="start"),
-            PostbackAction(label="不需要操作", data="logout"),
-        ],
-    )
-
-    template_message = TemplateMessage(
-        alt_text="請問你要進行什麼操作？", template=buttons_template
-    )
-    return template_message
-
-
-# 產生進度條
-def progress_bar(title: str, msg: str, current: int, max: int) -> str:
-    # 計算進度條的長度
-    progress = int(float(current) / float(max) * 100)
-    if progress > 100:
-        progress = 100
-
-    # 定義 Flex Message 的 JSON 格式
-    data = {
-        "type": "carousel",
-        "contents": [
-            {
-                "type": "bubble",
-                "size": "kilo",
-                "header": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "backgroundColor": "#27ACB2",
-                    "paddingTop": "19px",
-                    "paddingAll": "12px",
-                    "paddingBottom": "16px",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": title,
-                            "color": "#FFFFFF",
-                            "size": "md",
-                            "align": "start",
-                            "gravity": "center",
-                        },
-                        {
-                            "type": "text",
-                            "text": str(current) + "/" + str(max),
-                            "color": "#ffffff",
-                            "align": "start",
-                            "size": "xs",
-                            "gravity": "center",
-                            "margin": "lg",
-                        },
-                        {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "box",
-                                    "layout": "vertical",
-                                    "contents": [{"type": "filler"}],
-                                    "width": str(progress) + "%",
-                                    "backgroundColor": "#0D8186",
-                                    "height": "8px",
-                                }
-                            ],
-                            "backgroundColor": "#9FD8E3A0",
-                            "height": "8px",
-                            "margin": "sm",
-                        },
-                    ],
-                },
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "flex": 1,
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": msg,
-                            "color": "#8C8C8C",
-                            "size": "sm",
-                            "wrap": True,
-                        }
-                    ],
-                },
-                "styles": {"footer": {"separator": False}},
-            }
-        ],
-    }
-
-    return data
-
+# 背景處理事件的 worker，EVENT_WORKERS 為 0 時不啟用
+event_pool = None
 
-# 主動推送訊息給使用者
-def send_operation_options(line_bot_api, user_id):
-    print(user_id)
-    buttons_template = ButtonsTemplate(
-        title="請問你要進行什麼操作？",
-        text="請點擊以下選項",
-        actions=[
-            PostbackAction(label="開始集點", data="start"),
-            PostbackAction(label="不需要操作", data="logout"),
-        ],
-    )
+# 送出流量限制提示的執行緒，同一個人一段時間內只提示一次，排隊的數量不會無限增加
+notice_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RATE_LIMIT_NOTICE_WORKERS", 2)),
+    thread_name_prefix="rate-limit-notice",
+)
 
-    template_message = TemplateMessage(
-        alt_text="請問你要進行什麼操作？", template=buttons_template
-    )
-    line_bot_api.push_message_with_http_info(
-        PushMessageRequest(to=user_id, messages=[template_message])
-    )
+# 先用預估的點數回覆後，後端確認的點數不同時補送更正
+def stamp_correction(title: str, max_count: int):
+    def correct(user_id, result):
+        push_pipeline.push(user_id, conversation.correction(title, max_count, result))
 
-
-# 主動推送訊息給使用者
-def send_other_operation_options(line_bot_api, user_id):
-    buttons_template = ButtonsTemplate(
-        title="請問你還需要處理其他項目嗎？",
-        text="請點擊以下選項",
-        actions=[
-            PostbackAction(label="生理監測", data="monitor"),
-            PostbackAction(label="AI衛教", data="educate"),
-            PostbackAction(label="運動", data="exercise"),
-            PostbackAction(label="登出", data="logout"),
-        ],
-    )
-    template_message = TemplateMessage(
-        alt_text="請問你還需要處理其他項目嗎？", template=buttons_template
-    )
-    line_bot_api.push_message_with_http_info(
-        PushMessageRequest(to=user_id, messages=[template_message])
-    )
+    return correct
 
 
 @app.route(webhook, methods=["POST"])
+@metrics.timed("handler")
 def linebot():
 
     # get X-Line-Signature header value
@@ -213,56 +103,197 @@ def linebot():
 
     # get request body as text
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    # 只抽樣記錄，個資在背景執行緒遮掉
+    if logs.sample_body():
+        app.logger.info("Request body", extra={"body": body})
 
     # handle webhook body
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
+        for event in events:
+            # LINE 重送的事件已經處理過了，直接丟掉
+            if dedup.seen(event):
+                continue
+            # 超過流量限制的事件不處理，在讀取資料庫之前就擋下來
+            reason = ratelimit.check(event)
+            if reason != ratelimit.ALLOWED:
+                shed_event(event, reason)
+                continue
+            if event_pool is not None:
+                # 只在 request 中驗證簽章，事件交給背景 worker 處理
+                if not event_pool.submit(event):
+                    # 佇列滿了就放棄，不在這裡處理，以免和 worker 中同一個使用者的事件同時執行
+                    app.logger.warning(
+                        "Event queue full, event dropped",
+                        extra={"event_id": getattr(event, "webhook_event_id", None)},
+                    )
+            else:
+                dispatch_event(event)
     except Exception as e:
         app.logger.error(f"Error: {e}")
 
     return "OK"
 
 
-# 檢查身分證字號格式
-def check_id_number(idNumber) -> bool:
-    return re.match(r"^[A-Za-z]\d{9}$", idNumber)
+# 被限制的事件回覆固定的提示，或是直接丟掉
+# 提示交給背景執行緒送出，不在 webhook 的 request 裡等 LINE 回應
+def shed_event(event, reason):
+    text = ratelimit.notice(event, reason)
+    if text is None:
+        return
+    notice_executor.submit(send_notice, event, text)
+
+
+def send_notice(event, text: str):
+    try:
+        OutgoingMessages.for_event(event).add(TextMessage(text=text)).send(
+            line_client.get_api()
+        )
+    except Exception as e:
+        app.logger.error(f"Error while sending rate limit notice: {e}")
+
+
+# 依照事件類型找到對應的 handler，規則和 WebhookHandler.handle 相同
+def dispatch_event(event):
+    func = None
+    if isinstance(event, MessageEvent):
+        key = event.__class__.__name__ + "_" + event.message.__class__.__name__
+        func = handler._handlers.get(key)
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__)
+    if func is None:
+        func = handler._default
+    if func is not None:
+        func(event)
+
+
+@app.route("/stats/backend", methods=["GET"])
+def backend_stats():
+    return backend.stats()
+
+
+@app.route("/stats/breaker", methods=["GET"])
+def breaker_stats():
+    return backend.breaker_stats()
+
+
+@app.route("/stats/membership", methods=["GET"])
+def membership_stats():
+    return membership.stats()
+
+
+@app.route("/stats/warmup", methods=["GET"])
+def warmup_stats():
+    return warmup.stats()
+
+
+@app.route("/stats/routes", methods=["GET"])
+def route_stats():
+    return {"message": message_router.stats(), "postback": postback_router.stats()}
+
+
+@app.route("/stats/dedup", methods=["GET"])
+def dedup_stats():
+    return dedup.stats()
+
+
+@app.route("/stats/ratelimit", methods=["GET"])
+def ratelimit_stats():
+    return ratelimit.stats()
+
+
+@app.route("/stats/logs", methods=["GET"])
+def log_stats():
+    return logs.stats()
+
 
+@app.route("/stats/line", methods=["GET"])
+def line_stats():
+    return line_client.connection_stats()
+
+
+@app.route("/stats/db", methods=["GET"])
+def db_stats():
+    return {
+        "backend": db.backend_stats(),
+        "cache": db.cache_stats(),
+    }
+
+
+@app.route("/stats/flex", methods=["GET"])
+def flex_stats():
+    return flex_templates.cache_stats()
+
+
+@app.route("/stats/outgoing", methods=["GET"])
+def outgoing_stats():
+    return outgoing.stats()
+
+
+@app.route("/stats/push", methods=["GET"])
+def push_stats():
+    return push_pipeline.stats()
+
+
+@app.route("/stats/stamps", methods=["GET"])
+def stamp_stats():
+    return stamp_client.stats()
+
+
+@app.route("/stats/events", methods=["GET"])
+def event_stats():
+    if event_pool is None:
+        return {"enabled": False}
+    return {"enabled": True, **event_pool.stats()}
+
+
+# Prometheus 格式的統計資料，各個 /stats 的數值也會一起輸出
+@app.route("/metrics", methods=["GET"])
+def metrics_api():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+metrics.add_source("breaker", backend.breaker_stats)
+metrics.add_source("membership", membership.stats)
+metrics.add_source("warmup", warmup.stats)
+metrics.add_source("routes", route_stats)
+metrics.add_source("dedup", dedup.stats)
+metrics.add_source("ratelimit", ratelimit.stats)
+metrics.add_source("line", line_client.connection_stats)
+metrics.add_source("db", db_stats)
+metrics.add_source("flex", flex_templates.cache_stats)
+metrics.add_source("outgoing", outgoing.stats)
+metrics.add_source("push", push_pipeline.stats)
+metrics.add_source("stamps", stamp_client.stats)
+metrics.add_source("events", event_stats)
+metrics.add_source("logs", logs.stats)
 
-# 檢查電話號碼格式
-def check_tel(tel) -> bool:
-    return re.match(r"\d{10}", tel)
 
 def check_member(lineId) -> bool:
-    url = build_url("/searchLineID/")
     try:
-        response = requests.post(
-            url,
-            json={"lineId": lineId},
-        )
-        return response.status_code == 200
+        return membership.is_member(lineId)
     except Exception as e:
-        print(f"Error during request: {e}")
+        app.logger.error(f"Error during request: {e}")
         return False
 
 
 @handler.add(MessageEvent, message=TextMessageContent)
+@metrics.timed("handler")
 def handle_message(event):
 
     user_id = event.source.user_id
 
-    # 查詢使用者資料，取回前一次登入操作的資料
-    qdata = db.query_data(user_id)
-    if qdata is not None:
-        user_info = qdata
-    else:
-        # 沒有就建一個新的使用者資料
-        user_info = createUserInfo(user_id)
-        db.insert_data(user_id, user_info)
+    # 查詢使用者資料，取回前一次登入操作的資料，沒有就建一個新的使用者資料
+    user_info = db.get_or_create(user_id, createUserInfo(user_id))
 
-    push_message = False
-    msg_list, push_message = dispatch_type(
-        user_id, event.message.text, user_info)
+    # 註冊、登入流程中一直輸入錯誤的使用者放慢處理速度
+    if user_info["steptype"] is not None:
+        reason = ratelimit.check_errcount(user_id, user_info["errcount"])
+        if reason != ratelimit.ALLOWED:
+            shed_event(event, reason)
+            return
+
+    msg_list = dispatch_type(user_id, event.message.text, user_info)
 
     if len(msg_list) <= 0:
         if user_info["register"] == False:
@@ -274,509 +305,227 @@ def handle_message(event):
                 event.source.user_id, event.message.text)
 
     if len(msg_list) > 0:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            if push_message:
-                line_bot_api.push_message_with_http_info(
-                    PushMessageRequest(to=user_id, messages=msg_list)
-                )
-            else:
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
-                )
+        OutgoingMessages.for_event(event).add(*msg_list).send(line_client.get_api())
     return
 
 
-def createUserInfo(userid: str):
-    info = {
-        "user_id": userid,
-        "name": None,
-        "idNumber": None,
-        "tel": None,
-        "steptype": None,
-        "step": 0,
-        "errcount": 0,
-        "register": False,
-    }
-    return info
+# 以下的處理函式只負責讀寫資料庫與呼叫後端，流程的判斷都在 conversation.py，
+# asgi_app.py 有相同的 async 版本
+message_router = Router("message")
+postback_router = Router("postback")
 
 
 # 根據前一次的操作，分派訊息到對應的處理流程
-def dispatch_type(user_id: str, message: str, user_info) -> tuple[list, bool]:
-    msg_list = []
-    push_message = False
+@metrics.timed("handler")
+def dispatch_type(user_id: str, message: str, user_info) -> list:
+    msg_list = message_router.dispatch(
+        user_info["steptype"], user_info["step"], message, user_id, message, user_info
+    )
+    return msg_list or []
 
-    # 使用者沒有前一個步驟
-    if user_info["steptype"] == None:
 
-        if message == "新會員":
-            user_info["step"] = 1
-            user_info["steptype"] = "新會員"
-            db.update_data(user_id, user_info)
-            msg_list.append(TextMessage(text="請輸入姓名"))
-        elif message == "連結LINE集點" or message == "登入":
-            user_info["step"] = 1
-            user_info["steptype"] = "連結LINEID"
-            db.update_data(user_id, user_info)
-            msg_list.append(TextMessage(text="請輸入身分證字號"))
-        elif message == "集點":
-            url = build_url("/add/healthMeasurement")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
-            )
-            print(response.status_code)
-            data = response.json()
-            health_measurement = data.get(
-                "healthMeasurement")  # 使用 .get() 確保鍵存在
-            if response.status_code == 200:
-
-                flex = progress_bar("集點券", "目前集點進度", health_measurement, 15)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
+# 使用者沒有前一個步驟
+@message_router.route("新會員")
+def start_register(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.start_register(user_info)
+    db.update_data(user_id, user_info)
+    return msg_list
 
-                if health_measurement < 15:
-                    reply_text = f"集點成功，加油!!"
-                if health_measurement == 15:
-                    reply_text = f"集滿囉!!!可以拿給志工確認換禮物囉~"
-                if health_measurement > 15:
-                    reply_text = "有持續量血壓很棒喔~"
-                msg_list.append(TextMessage(text=reply_text))
-            else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                msg_list.append(TextMessage(text=reply_text))
-        elif message == "所有集點":
-            msg_list.append(create_operation_options())
-            push_message = True
-        elif message == "登入":
-            user_info["steptype"] = "登入"
-            reply_text = "請輸入身分證字號"
-            msg_list.append(TextMessage(text=reply_text))
-    else:
 
-        if user_info["steptype"] == "連結LINEID":
-            idNumber = message
-            lineId = user_id
+@message_router.route("連結LINE集點", "登入")
+def start_link(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.start_link(user_info)
+    db.update_data(user_id, user_info)
+    return msg_list
 
-            if check_id_number(idNumber):
-                try:
-                    url = build_url("/linkLineID/")
-                    response = requests.post(
-                        url,
-                        json={"idNumber": idNumber, "lineId": lineId},
-                    )
-                    data = response.json()
-                    response_message = data.get("detail")
-                    if response.status_code == 200:
-                        reply_text = "連結成功"
-                    elif response.status_code == 400 :
-                        reply_text = response_message
-                    else:
-                        reply_text = "重複連結或錯誤，請確認!"
-                except Exception as e:
-                    print(f"Error during request: {e}")
-                    reply_text = "請聯絡管理員"
-
-                msg_list.append(TextMessage(text=reply_text))
-                # 完成步驟後，重設步驟狀態（如果需要）
-                user_info["steptype"] = None
-                user_info["step"] = 0  # 重設步驟為0
-                user_info["errcount"] = 0
-                db.update_data(user_id, user_info)
-            else:
-                user_info["errcount"] += 1
-                db.update_data(user_id, user_info)
-                reply_text = (
-                    "身分證字號格式錯誤，請輸入有效的身分證字號（1個字母 + 9個數字）"
-                )
-                msg_list.append(TextMessage(text=reply_text))
-
-        elif user_info["steptype"] == "新會員":
-            if user_info["step"] == 1:
-                user_info["step"] = 2
-                user_info["name"] = message
-                db.update_data(user_id, user_info)
-                reply_text = "請輸入身分證字號"
-                msg_list.append(TextMessage(text=reply_text))
-            elif user_info["step"] == 2:
-                if check_id_number(message):
-                    user_info["idNumber"] = message
-                    user_info["step"] = 3
-                    db.update_data(user_id, user_info)
-                    reply_text = "請輸入電話號碼"
-                    msg_list.append(TextMessage(text=reply_text))
-
-                else:
-                    user_info["errcount"] += 1
-                    db.update_data(user_id, user_info)
-                    reply_text = "格式錯誤！請輸入 1 個英文字母和 9 個數字。"
-                    msg_list.append(TextMessage(text=reply_text))
-            elif user_info["step"] == 3:
-                user_info["tel"] = message
-                user_info["step"] = 4
-                db.update_data(user_id, user_info)
-                # Create confirmation template message
-                buttons_template = ButtonsTemplate(
-                    title="請確認您的資料",
-                    text=(
-                        f"您的姓名是 {user_info['name']}、\n"
-                        f"身份證字號是 {user_info['idNumber']}、\n"
-                        f"電話是 {user_info['tel']}。\n請問是否正確？"
-                    ),
-                    actions=[
-                        PostbackAction(label="是", data="correct"),
-                        PostbackAction(label="否", data="incorrect"),
-                    ],
-                )
-                template_message = TemplateMessage(
-                    alt_text="確認資料", template=buttons_template
-                )
-                msg_list.append(template_message)
-
-            elif user_info["step"] == 4:
-                if check_id_number(message):
-                    user_info["idNumber"] = message
-                    try:
-                        url = build_url("/search/")
-                        response = requests.get(
-                            url,
-                            json={"idNumber": user_info["idNumber"]},
-                        )
-                        print(response, user_info["idNumber"])
-                        if response.status_code == 200:
-                            # 成功後，清掉步驟並發送操作選項
-                            user_info["steptype"] = None
-                            user_info["step"] = 0  # 重設步驟為0
-                            user_info["errcount"] = 0
-                            db.update_data(user_id, user_info)
-                            print(user_id, user_info)
-                            
-                            idNumber = user_info['idNumber']
-                            lineId = user_id
-
-                            try:
-                                url = build_url("/linkLineID/")
-                                response = requests.post(
-                                    url,
-                                    json={"idNumber": idNumber, "lineId": lineId},
-                                )
-                                if response.status_code == 200:
-                                    reply_text = "連結成功"
-                                else:
-                                    reply_text = "重複連結或錯誤，請確認!"
-                            except Exception as e:
-                                print(f"Error during request: {e}")
-                                reply_text = "請聯絡管理員"
-
-                            msg_list.append(create_operation_options())
-                            push_message = True
-                        else:
-                            reply_text = "請註冊!!"
-                            msg_list.append(TextMessage(text=reply_text))
-
-                    except:
-                        reply_text = "請聯絡管理員"
-                        msg_list.append(TextMessage(text=reply_text))
-                else:
-                    user_info["errcount"] += 1
-                    db.update_data(user_id, user_info)
-                    reply_text = "登入步驟錯誤或身分證字號格式錯誤"
-                    msg_list.append(TextMessage(text=reply_text))
-            
-    return msg_list, push_message
 
+@message_router.route("集點")
+def stamp_message(user_id: str, message: str, user_info) -> list:
+    category, title, max_count = conversation.STAMP_MESSAGE
+    result = stamp_client.add(
+        user_info["user_id"], category, stamp_correction(title, max_count)
+    )
+    app.logger.debug(
+        "Stamp added", extra={"user_id": user_id, "status": result.status_code}
+    )
+    return conversation.stamp_reply(result)
 
-@handler.add(PostbackEvent)
-def handle_postback(event):
-    msg_list = []
 
-    qdata = db.query_data(event.source.user_id)
-    if qdata is not None:
-        user_info = qdata
-    else:
-        print("No result found")
-        user_info = createUserInfo(event.source.user_id)
-        db.insert_data(event.source.user_id, user_info)
+@message_router.route("所有集點")
+def all_stamps(user_id: str, message: str, user_info) -> list:
+    return [create_operation_options()]
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        
-        tk = event.reply_token
-        data = event.postback.data
 
-        if data == "correct":
-            try:
-                url = build_url("/add_user/")
-                response = requests.post(
-                    url,
-                    json={
-                        "name": user_info["name"],
-                        "idNumber": user_info["idNumber"],
-                        "tel": user_info["tel"],
-                    },  # 傳遞的 JSON 資料
-                )
-                if response.status_code == 200:
-                    # Confirm registration completion
-                    user_info["register"] = True
-                    db.update_data(event.source.user_id, user_info)
-
-                    reply_text = "註冊完成！請輸入身分證字號登入"
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)],
-                        )
-                    )
-                else:
-                    reply_text = "註冊失敗！請稍後嘗試!"
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_text)],
-                        )
-                    )
-            except:
-                reply_text = "請聯絡管理員"
-                # Confirm registration completion
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
-                )
-        elif data == "incorrect":
-            # Reset user information if incorrect
-            user_info = createUserInfo(event.source.user_id)
-            user_info["steptype"] = "新會員"
-            user_info["step"] = 1
-            db.update_data(event.source.user_id, user_info)
+@message_router.route(steptype="連結LINEID")
+def link_line_id(user_id: str, message: str, user_info) -> list:
+    if not check_id_number(message):
+        msg_list = conversation.input_error(user_info, conversation.LINK_FORMAT_ERROR)
+        db.update_data(user_id, user_info)
+        return msg_list
 
-            reply_text = "請重新輸入姓名"
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text)],
-                )
-            )
-        elif data == "start":
-            buttons_template = ButtonsTemplate(
-                title="請問你要處理哪個項目？",
-                text="請點擊以下選項",
-                actions=[
-                    PostbackAction(label="生理監測", data="monitor"),
-                    PostbackAction(label="AI衛教", data="educate"),
-                    PostbackAction(label="運動", data="exercise"),
-                    PostbackAction(label="登出", data="logout"),
-                ],
-            )
-
-            template_message = TemplateMessage(
-                alt_text="請問你要進行什麼集點？", template=buttons_template
-            )
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token, messages=[template_message]
-                )
-            )
-        elif data == "logout":
-            user_info["steptype"] = None
-            user_info["step"] = 0
-            user_info["errcount"] = 0
-            db.update_data(event.source.user_id, user_info)
-            
+    try:
+        response = backend.post(
+            "/linkLineID/",
+            json={"idNumber": message, "lineId": user_id},
+        )
+    except Exception as e:
+        app.logger.error(f"Error during request: {e}")
+        response = None
+    msg_list = conversation.link_result(user_info, message, response)
+    db.update_data(user_id, user_info)
+    return msg_list
+
+
+@message_router.route(steptype="新會員", step=1)
+def register_name(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.register_name(user_info, message)
+    db.update_data(user_id, user_info)
+    return msg_list
+
+
+@message_router.route(steptype="新會員", step=2)
+def register_id_number(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.register_id_number(user_info, message)
+    db.update_data(user_id, user_info)
+    return msg_list
+
+
+@message_router.route(steptype="新會員", step=3)
+def register_tel(user_id: str, message: str, user_info) -> list:
+    msg_list = conversation.register_tel(user_info, message)
+    db.update_data(user_id, user_info)
+    return msg_list
+
+
+@message_router.route(steptype="新會員", step=4)
+def register_login(user_id: str, message: str, user_info) -> list:
+    if not check_id_number(message):
+        msg_list = conversation.input_error(user_info, conversation.LOGIN_FORMAT_ERROR)
+        db.update_data(user_id, user_info)
+        return msg_list
+
+    user_info["idNumber"] = message
+    try:
+        registered = membership.id_registered(message)
+        app.logger.debug(
+            "ID number checked", extra={"user_id": user_id, "registered": registered}
+        )
+        msg_list = conversation.login_result(user_info, registered)
+        if registered:
+            db.update_data(user_id, user_info)
+            app.logger.info("User logged in", extra={"user_info": user_info})
             try:
-                url = build_url("/logout/")
-                response = requests.delete(
-                    url,
-                    json={"lineId": user_info["user_id"]},
+                response = backend.post(
+                    "/linkLineID/",
+                    json={"idNumber": message, "lineId": user_id},
                 )
                 if response.status_code == 200:
-                    reply_text = "登出成功"
-                else:
-                    reply_text = "請重試"
+                    conversation.linked(user_id, message)
             except Exception as e:
-                    print(f"Error during request: {e}")
-                    reply_text = "請聯絡管理員"
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_text)],
-                )
-            )
-        elif data == "monitor":
-            url = build_url("/add/healthMeasurement")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
-            )
-            
-            data = response.json()
-            health_measurement = data.get("healthMeasurement")
-            
-            if response.status_code == 200:
-                flex = progress_bar("量血壓次數", "目前集點進度", health_measurement, 15)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
+                app.logger.error(f"Error during request: {e}")
+        return msg_list
+    except:
+        return conversation.text_reply(conversation.CONTACT_ADMIN)
 
-                reply_text = "集點完成"
-                msg_list.append(TextMessage(text=reply_text))
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
-                )
-                send_other_operation_options(line_bot_api, user_info["user_id"])
-            else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
-                )
-        elif data == "educate":
-            url = build_url("/add/healthEducation")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
-            )
-            
-            data = response.json()
-            health_education = data.get("healthEducation")
-            
-            if response.status_code == 200:
-                
-                flex = progress_bar("AI衛教次數", "目前集點進度", health_education, 2)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
-                
-                reply_text = "集點完成"
-                msg_list.append(TextMessage(text=reply_text))
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
-                )
-            else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
-                )
-            send_other_operation_options(line_bot_api, user_info["user_id"])
-        elif data == "exercise":
-            url = build_url("/add/exercise")
-            response = requests.put(
-                url,
-                json={"lineId": user_info["user_id"]},  # 傳遞的 JSON 資料
-            )
-            
-            data = response.json()
-            exercise = data.get("exercise")
-            
-            if response.status_code == 200:
-                flex = progress_bar("運動次數", "目前集點進度", exercise, 6)
-                msg_list.append(
-                    FlexMessage(
-                        alt_text="hello", contents=FlexContainer.from_dict(flex)
-                    )
-                )
 
-                reply_text = "集點完成"
-                msg_list.append(TextMessage(text=reply_text))
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=msg_list,
-                    )
-                )
-            else:
-                reply_text = "集點失敗！請稍後嘗試!"
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_text)],
-                    )
-                )
-            send_other_operation_options(line_bot_api, user_info["user_id"])
+@handler.add(PostbackEvent)
+@metrics.timed("handler")
+def handle_postback(event):
+    user_info = db.get_or_create(
+        event.source.user_id, createUserInfo(event.source.user_id)
+    )
+
+    # 要送出的訊息都先放這裡，最後合併成一次回覆
+    outgoing = OutgoingMessages.for_event(event)
+    postback_router.dispatch(None, None, event.postback.data, event, user_info, outgoing)
+    outgoing.send(line_client.get_api())
+
+
+@postback_router.route("correct")
+def confirm_register(event, user_info, outgoing):
+    try:
+        response = backend.post("/add_user/", json=conversation.member_data(user_info))
+        msg_list = conversation.register_result(user_info, response.status_code)
+        if response.status_code == 200:
+            db.update_data(event.source.user_id, user_info)
+    except:
+        msg_list = conversation.text_reply(conversation.CONTACT_ADMIN)
+    outgoing.add(*msg_list)
+
+
+@postback_router.route("incorrect")
+def restart_register(event, user_info, outgoing):
+    user_info, msg_list = conversation.restart_register(event.source.user_id)
+    db.update_data(event.source.user_id, user_info)
+    outgoing.add(*msg_list)
+
+
+@postback_router.route("start")
+def start_menu(event, user_info, outgoing):
+    outgoing.add(message_templates.START_MENU)
+
+
+@postback_router.route("logout")
+def logout(event, user_info, outgoing):
+    conversation.reset_steps(user_info)
+    db.update_data(event.source.user_id, user_info)
+
+    try:
+        response = backend.delete(
+            "/logout/",
+            json={"lineId": user_info["user_id"]},
+        )
+        msg_list = conversation.logout_result(user_info, response.status_code)
+    except Exception as e:
+        app.logger.error(f"Error during request: {e}")
+        msg_list = conversation.text_reply(conversation.CONTACT_ADMIN)
+    outgoing.add(*msg_list)
+
+
+@postback_router.route(*STAMP_POSTBACKS)
+def stamp_postback(event, user_info, outgoing):
+    category, title, max_count, _ = STAMP_POSTBACKS[event.postback.data]
+    result = stamp_client.add(
+        user_info["user_id"], category, stamp_correction(title, max_count)
+    )
+    conversation.add_stamp_postback_reply(outgoing, event.postback.data, result)
 
 
 # 加入好友
 @handler.add(FollowEvent)
 def handle_follow(event):
-    app.logger.info("Got Follow event:" + event.source.user_id)
+    app.logger.info("Got Follow event", extra={"user_id": event.source.user_id})
     msg_list = []
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
-        try:
-            profile = line_bot_api.get_profile(event.source.user_id)
-            print(profile.display_name)
-            welcometitle = "您好！歡迎使用健康小幫手，您看起來還不是我們會員，請選擇新會員或其他以獲得服務。"
-            if profile.display_name:
-                welcometitle = profile.display_name + welcometitle
-
-            msg_list.append(TextMessage(text=welcometitle))
-
-            buttons_template = ButtonsTemplate(
-                title="服務選單",
-                text="請點擊以下選項",
-                actions=[
-                    MessageAction(label="新會員", text="新會員"),
-                    PostbackAction(label="其他", data="idontknow"),
-                ],
-            )
-
-            template_message = TemplateMessage(
-                alt_text="歡迎新朋友～", template=buttons_template
-            )
-
-            msg_list.append(template_message)
-
-        except LineBotApiError as e:
-            print(e.status_code)
-
-        if len(msg_list) > 0:
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=msg_list,
-                )
-            )
+    line_bot_api = line_client.get_api()
+
+    try:
+        profile = line_bot_api.get_profile(event.source.user_id)
+        msg_list = conversation.welcome(profile)
+    except LineBotApiError as e:
+        app.logger.error("Error while getting profile", extra={"status": e.status_code})
+
+    if len(msg_list) > 0:
+        OutgoingMessages.for_event(event).add(*msg_list).send(line_bot_api)
 
 
 # 取消好友
 @handler.add(UnfollowEvent)
 def handle_unfollow(event):
     # 看法規政策 有時候可能需要刪除使用者資料
-    app.logger.info("Got Unfollow event:" + event.source.user_id)
+    app.logger.info("Got Unfollow event", extra={"user_id": event.source.user_id})
+    db.forget_user(event.source.user_id)
+    stamp_client.forget(event.source.user_id)
 
 
 # 其他訊息的回應
 def process_message(userid: str, msg: str) -> list:
-    global health_info
     msg_list = []
 
     if msg != None and msg != "":
-        if msg in health_info:
-            msg_list.append(TextMessage(text=health_info[msg]))
+        # 訊息中有提到的關鍵字或同義詞都會回覆
+        for answer in health_index.lookup(msg, HEALTH_MAX_ANSWERS):
+            msg_list.append(TextMessage(text=answer))
         # else:
         #     # 隨機從health_info內取一個內容
         #     random_key, random_value = random.choice(list(health_info.items()))
@@ -787,12 +536,12 @@ def process_message(userid: str, msg: str) -> list:
 
 # 讀取健康資訊
 def load_health_info(config_name: str):
-    global health_info
+    global health_info, health_index
 
     try:
         fh = open(config_name, "rt", encoding="utf-8")
     except:
-        print(f"'{config_name}' not found")
+        app.logger.error(f"'{config_name}' not found")
         exit()
 
     filedata = fh.read()
@@ -800,12 +549,30 @@ def load_health_info(config_name: str):
 
     fh.close()
 
+    # 建立關鍵字索引，之後每則訊息只要查索引
+    health_index = HealthIndex.from_dict(health_info)
+
 
 def main():
+    global event_pool
 
     db.init_db()
     load_health_info("bot_health_info.json")
 
+    workers = int(os.getenv("EVENT_WORKERS", 0))
+    if workers > 0:
+        event_pool = EventWorkerPool(
+            dispatch_event,
+            workers=workers,
+            maxsize=int(os.getenv("EVENT_QUEUE_SIZE", 1000)),
+        )
+        event_pool.start()
+
+    if os.getenv("PUSH_PIPELINE", "false").lower() == "true":
+        push_pipeline.start()
+
+    warmup.start()
+
     host_ip = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", 5000))  # 默認使用 5000，但優先使用環境變數 PORT
 
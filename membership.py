@@ -0,0 +1,161 @@
+"""
+會員身分查詢的快取
+- LINE ID 是否已經連結會員 (/searchLineID/)
+- 身分證字號是否已經註冊 (/search/)
+
+會員資料很少變動，查到的結果保留 MEMBER_CACHE_TTL 秒，
+查不到 (不是會員) 的結果也會保留，但時間比較短 (MEMBER_CACHE_NEGATIVE_TTL)，
+後端錯誤的結果不保留
+
+/linkLineID/、/add_user/、/logout/ 成功後要呼叫 invalidate_* 清掉對應的資料
+
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+import backend_client as backend
+
+load_dotenv()
+
+
+class TTLCache:
+    def __init__(self, ttl: float, negative_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # key -> (到期時間, 值)
+        self.entries = OrderedDict()
+
+        # 統計資料
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # 回傳 (是否有快取, 值)
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            if entry[1]:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return True, entry[1]
+
+    def put(self, key, value: bool):
+        ttl = self.ttl if value else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0
+                ),
+                "invalidations": self.invalidations,
+            }
+
+
+TTL = float(os.getenv("MEMBER_CACHE_TTL", 300))
+NEGATIVE_TTL = float(os.getenv("MEMBER_CACHE_NEGATIVE_TTL", 30))
+MAX_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", 10000))
+
+# LINE ID -> 是否已連結會員
+line_ids = TTLCache(TTL, NEGATIVE_TTL, MAX_SIZE)
+# 身分證字號 -> 是否已註冊
+id_numbers = TTLCache(TTL, NEGATIVE_TTL, MAX_SIZE)
+
+
+# 200 表示存在，4xx 表示不存在，其他狀態 (5xx) 回傳 None 不快取
+def _found(status_code: int):
+    if status_code == 200:
+        return True
+    if 400 <= status_code < 500:
+        return False
+    return None
+
+
+def _lookup(cache: TTLCache, key: str, status_code: int) -> bool:
+    found = _found(status_code)
+    if found is None:
+        return False
+    cache.put(key, found)
+    return found
+
+
+# LINE ID 是否已經連結會員，後端錯誤時會丟出例外
+def is_member(line_id: str) -> bool:
+    cached, value = line_ids.get(line_id)
+    if cached:
+        return value
+    response = backend.post("/searchLineID/", json={"lineId": line_id})
+    return _lookup(line_ids, line_id, response.status_code)
+
+
+# 身分證字號是否已經註冊，後端錯誤時會丟出例外
+def id_registered(id_number: str) -> bool:
+    cached, value = id_numbers.get(id_number)
+    if cached:
+        return value
+    response = backend.get("/search/", json={"idNumber": id_number})
+    return _lookup(id_numbers, id_number, response.status_code)
+
+
+async def ais_member(line_id: str) -> bool:
+    cached, value = line_ids.get(line_id)
+    if cached:
+        return value
+    response = await backend.apost("/searchLineID/", json={"lineId": line_id})
+    return _lookup(line_ids, line_id, response.status_code)
+
+
+async def aid_registered(id_number: str) -> bool:
+    cached, value = id_numbers.get(id_number)
+    if cached:
+        return value
+    response = await backend.aget("/search/", json={"idNumber": id_number})
+    return _lookup(id_numbers, id_number, response.status_code)
+
+
+def invalidate_line_id(line_id: str):
+    line_ids.invalidate(line_id)
+
+
+def invalidate_id_number(id_number: str):
+    id_numbers.invalidate(id_number)
+
+
+def stats() -> dict:
+    return {"line_ids": line_ids.stats(), "id_numbers": id_numbers.stats()}
@@ -0,0 +1,66 @@
+"""
+固定不變的選單訊息
+程式載入時就建立並驗證好，所有執行緒共用同一份物件，不用每個事件都重新建立
+
+這些物件會被共用，取出後不可以修改，需要不同內容時請另外建立新的訊息
+
+"""
+
+from linebot.v3.messaging import (
+    ButtonsTemplate,
+    MessageAction,
+    PostbackAction,
+    TemplateMessage,
+)
+
+
+def _buttons(alt_text: str, title: str, actions: list) -> TemplateMessage:
+    return TemplateMessage(
+        alt_text=alt_text,
+        template=ButtonsTemplate(title=title, text="請點擊以下選項", actions=actions),
+    )
+
+
+# 集點項目的按鈕
+def _stamp_actions() -> list:
+    return [
+        PostbackAction(label="生理監測", data="monitor"),
+        PostbackAction(label="AI衛教", data="educate"),
+        PostbackAction(label="運動", data="exercise"),
+        PostbackAction(label="登出", data="logout"),
+    ]
+
+
+# 請問你要進行什麼操作
+OPERATION_OPTIONS = _buttons(
+    "請問你要進行什麼操作？",
+    "請問你要進行什麼操作？",
+    [
+        PostbackAction(label="開始集點", data="start"),
+        PostbackAction(label="不需要操作", data="logout"),
+    ],
+)
+
+# 集點完成後，詢問是否還要處理其他項目
+OTHER_OPERATION_OPTIONS = _buttons(
+    "請問你還需要處理其他項目嗎？",
+    "請問你還需要處理其他項目嗎？",
+    _stamp_actions(),
+)
+
+# 按下開始集點後的選單
+START_MENU = _buttons(
+    "請問你要進行什麼集點？",
+    "請問你要處理哪個項目？",
+    _stamp_actions(),
+)
+
+# 加入好友時的服務選單
+WELCOME_MENU = _buttons(
+    "歡迎新朋友～",
+    "服務選單",
+    [
+        MessageAction(label="新會員", text="新會員"),
+        PostbackAction(label="其他", data="idontknow"),
+    ],
+)
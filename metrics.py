@@ -0,0 +1,223 @@
+"""
+延遲、錯誤次數與處理中數量的統計，/metrics 用 Prometheus 的文字格式輸出
+
+每個量測點用 (component, name) 區分，例如 ("handler", "handle_message")、
+("persistence", "get_or_create")、("backend", "PUT /add/exercise")、("line", "reply")，
+會記錄：
+    linebot_latency_seconds   延遲分佈 (histogram)
+    linebot_errors_total      發生例外或是被標記為錯誤的次數
+    linebot_in_flight         正在處理中的數量
+
+各模組原本的 stats() 也可以用 add_source 加進來，數值會變成 linebot_stat 的 gauge
+
+不需要額外的套件，track 每次量測只在開始和結束各加鎖一次 (observe 只有一次)，
+加上一次 bisect，可以一直開著
+METRICS_ENABLED=false 時不記錄
+
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# 延遲分佈的區間上限，單位秒
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Series:
+    __slots__ = ("buckets", "count", "sum", "errors", "in_flight")
+
+    def __init__(self):
+        # 最後一格是超過最大區間的次數
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self.in_flight = 0
+
+
+_lock = threading.Lock()
+_series = {}
+# 名稱 -> 回傳 dict 的函式
+_sources = {}
+
+
+# 呼叫時必須持有 _lock
+def _get(component: str, name: str) -> _Series:
+    key = (component, name)
+    series = _series.get(key)
+    if series is None:
+        series = _series[key] = _Series()
+    return series
+
+
+# 呼叫時必須持有 _lock
+def _add(series: _Series, index: int, elapsed: float, error: bool):
+    series.buckets[index] += 1
+    series.count += 1
+    series.sum += elapsed
+    if error:
+        series.errors += 1
+
+
+def observe(component: str, name: str, elapsed: float, error: bool = False):
+    if not ENABLED:
+        return
+    index = bisect_left(BUCKETS, elapsed)
+    with _lock:
+        _add(_get(component, name), index, elapsed, error)
+
+
+# 回傳的 series 不會被移除，結束時直接使用，不用再查一次
+def _enter(component: str, name: str) -> _Series:
+    with _lock:
+        series = _get(component, name)
+        series.in_flight += 1
+        return series
+
+
+# 結束時減少處理中的數量並記錄這次的結果，只加鎖一次
+def _leave(series: _Series, elapsed: float, error: bool):
+    index = bisect_left(BUCKETS, elapsed)
+    with _lock:
+        series.in_flight -= 1
+        _add(series, index, elapsed, error)
+
+
+class Span:
+    __slots__ = ("error",)
+
+    def __init__(self):
+        self.error = False
+
+
+# 量測一段程式，發生例外或設定 span.error = True 時算一次錯誤
+@contextmanager
+def track(component: str, name: str):
+    span = Span()
+    if not ENABLED:
+        yield span
+        return
+    series = _enter(component, name)
+    start = time.monotonic()
+    try:
+        yield span
+    except BaseException:
+        span.error = True
+        raise
+    finally:
+        _leave(series, time.monotonic() - start, span.error)
+
+
+# 量測函式的裝飾器，async 函式也可以用，沒有指定 name 時用函式名稱
+def timed(component: str, name: str = None):
+    def decorator(func):
+        label = name or func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with track(component, label):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(component, label):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# 把模組的 stats() 加到 /metrics
+def add_source(name: str, func):
+    _sources[name] = func
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+# 把巢狀的 dict 攤平成 (key, 數值)，只保留數字
+def _flatten(data, prefix: str = ""):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from _flatten(value, f"{prefix}{key}_")
+    elif isinstance(data, bool):
+        yield prefix.rstrip("_"), int(data)
+    elif isinstance(data, (int, float)):
+        yield prefix.rstrip("_"), data
+
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+
+def render() -> str:
+    with _lock:
+        snapshot = [
+            (component, name, list(s.buckets), s.count, s.sum, s.errors, s.in_flight)
+            for (component, name), s in sorted(_series.items())
+        ]
+
+    lines = [
+        "# HELP linebot_latency_seconds Latency of handlers, storage, backend and LINE API calls.",
+        "# TYPE linebot_latency_seconds histogram",
+    ]
+    for component, name, buckets, count, total, _, _ in snapshot:
+        labels = _labels(component=component, name=name)
+        cumulative = 0
+        for bound, value in zip(BUCKETS, buckets):
+            cumulative += value
+            lines.append(
+                f'linebot_latency_seconds_bucket{{{labels},le="{_format_bound(bound)}"}} {cumulative}'
+            )
+        lines.append(f'linebot_latency_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"linebot_latency_seconds_sum{{{labels}}} {total}")
+        lines.append(f"linebot_latency_seconds_count{{{labels}}} {count}")
+
+    lines.append("# HELP linebot_errors_total Calls that raised or returned an error.")
+    lines.append("# TYPE linebot_errors_total counter")
+    for component, name, _, _, _, errors, _ in snapshot:
+        lines.append(f"linebot_errors_total{{{_labels(component=component, name=name)}}} {errors}")
+
+    lines.append("# HELP linebot_in_flight Calls currently in progress.")
+    lines.append("# TYPE linebot_in_flight gauge")
+    for component, name, _, _, _, _, in_flight in snapshot:
+        lines.append(f"linebot_in_flight{{{_labels(component=component, name=name)}}} {in_flight}")
+
+    lines.append("# HELP linebot_stat Values reported by the /stats endpoints.")
+    lines.append("# TYPE linebot_stat gauge")
+    for source, func in sorted(_sources.items()):
+        try:
+            data = func()
+        except Exception as e:
+            logger.error(f"Error while collecting {source} stats: {e}")
+            continue
+        for key, value in _flatten(data):
+            lines.append(f"linebot_stat{{{_labels(source=source, key=key)}}} {value}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,146 @@
+"""
+整理一個事件要送出的所有訊息
+handler 先把要送的訊息都加進來，最後一次送出：
+reply token 還有效時，最多 5 則訊息合併成一次回覆 (回覆不會算進每月的訊息額度)，
+超過 5 則的部分或 reply token 已經失效時才改用推送
+
+"""
+
+import threading
+import time
+
+from linebot.v3.messaging import PushMessageRequest, ReplyMessageRequest
+from linebot.v3.messaging.exceptions import ApiException
+
+import metrics
+
+# 一次回覆或推送最多可以帶的訊息數
+MAX_MESSAGES = 5
+
+# reply token 大約一分鐘後失效，留一點緩衝
+REPLY_TOKEN_TTL = 50
+
+_lock = threading.Lock()
+_stats = {
+    "replies": 0,
+    "pushes": 0,
+    "fallback_pushes": 0,
+    "saved_calls": 0,
+}
+
+
+def _count(**values):
+    with _lock:
+        for key, value in values.items():
+            _stats[key] += value
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats)
+
+
+class OutgoingMessages:
+    def __init__(self, user_id: str, reply_token: str = None, timestamp: int = None):
+        self.user_id = user_id
+        self.reply_token = reply_token
+        # 事件發生的時間 (毫秒)，用來判斷 reply token 是否還有效
+        self.timestamp = timestamp
+        self.messages = []
+        # 沒有合併時原本要呼叫幾次 API
+        self.groups = 0
+
+    @classmethod
+    def for_event(cls, event):
+        return cls(
+            event.source.user_id,
+            getattr(event, "reply_token", None),
+            getattr(event, "timestamp", None),
+        )
+
+    # 加入一組訊息，一組相當於原本的一次回覆或推送
+    def add(self, *messages):
+        if messages:
+            self.messages.extend(messages)
+            self.groups += 1
+        return self
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def can_reply(self) -> bool:
+        if not self.reply_token:
+            return False
+        if self.timestamp is None:
+            return True
+        return time.time() - self.timestamp / 1000 < REPLY_TOKEN_TTL
+
+    def _chunks(self):
+        return [
+            self.messages[index : index + MAX_MESSAGES]
+            for index in range(0, len(self.messages), MAX_MESSAGES)
+        ]
+
+    def _record(self, calls: int):
+        _count(saved_calls=max(0, self.groups - calls))
+
+    # 送出所有訊息
+    def send(self, line_bot_api):
+        if not self.messages:
+            return
+        chunks = self._chunks()
+        calls = 0
+
+        if self.can_reply():
+            try:
+                with metrics.track("line", "reply"):
+                    line_bot_api.reply_message_with_http_info(
+                        ReplyMessageRequest(reply_token=self.reply_token, messages=chunks[0])
+                    )
+                chunks = chunks[1:]
+                _count(replies=1)
+            except ApiException as e:
+                # reply token 失效，全部改用推送
+                if e.status != 400:
+                    raise
+                _count(fallback_pushes=1)
+            calls += 1
+
+        for chunk in chunks:
+            with metrics.track("line", "push"):
+                line_bot_api.push_message_with_http_info(
+                    PushMessageRequest(to=self.user_id, messages=chunk)
+                )
+            _count(pushes=1)
+            calls += 1
+        self._record(calls)
+
+    # async 版本，給 asgi_app 使用
+    async def asend(self, line_bot_api):
+        if not self.messages:
+            return
+        chunks = self._chunks()
+        calls = 0
+
+        if self.can_reply():
+            try:
+                with metrics.track("line", "reply"):
+                    await line_bot_api.reply_message_with_http_info(
+                        ReplyMessageRequest(reply_token=self.reply_token, messages=chunks[0])
+                    )
+                chunks = chunks[1:]
+                _count(replies=1)
+            except ApiException as e:
+                if e.status != 400:
+                    raise
+                _count(fallback_pushes=1)
+            calls += 1
+
+        for chunk in chunks:
+            with metrics.track("line", "push"):
+                await line_bot_api.push_message_with_http_info(
+                    PushMessageRequest(to=self.user_id, messages=chunk)
+                )
+            _count(pushes=1)
+            calls += 1
+        self._record(calls)
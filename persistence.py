@@ -1,76 +1,1021 @@
 """
 這是一個用來存取資料的模組
-如果沒有連到資料庫，會先將資料存到記憶體中
-存到記憶體的資料會在程式結束後消失
+資料可以存在不同的地方，用環境變數 DB_BACKEND 選擇：
+    memory  存在記憶體中，程式結束後資料會消失 (沒有設定 DB 時的預設值)
+    mongo   存在 MongoDB (ENABLE_DB=true 時的預設值)
+    sqlite  存在本機的 SQLite 檔案 (WAL 模式)，同一台主機上的多個 worker
+            行程可以共用，不需要另外架資料庫
 
-環境變數沒有DB的設定時，會預設將資料存到記憶體中
+記憶體中最多保留 MEMORY_STORE_SIZE 個使用者，超過時從最久沒互動的使用者開始移除，
+進行中步驟 (steptype 不是 None) 的使用者會盡量保留，但閒置超過 MEMORY_STORE_IDLE 秒一樣會移除
+
+使用 mongo 或 sqlite 時，可以用 DB_CACHE_MODE 在前面加一層快取：
+    off            每次都直接讀寫資料庫 (預設)
+    write-through  讀取走快取，寫入時同步寫到資料庫
+    write-behind   寫入只改快取，背景執行緒每隔一段時間用 put_many 一次寫回，
+                   同一個使用者在這段時間內的多次更新會合併成一次寫入，
+                   資料最多落後 DB_CACHE_MAX_STALENESS 秒
+
+MongoDB 的連線池大小、逾時、write concern 與 read preference 都可以用環境變數設定，
+啟動時會先 ping 資料庫並建立連線，連不上時改用記憶體儲存
+
+MongoDB 的 user_id 有唯一索引，讀取時只取 user_info 的欄位，
+更新時只送出有改變的欄位
+
+mark_event 記錄處理過的 webhook 事件，多個行程共用時可以擋掉重送的事件
 
 """
 
+import atexit
+import datetime
+import json
+import logging
 import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+from pymongo.monitoring import ConnectionPoolListener
+
+import metrics
 
 # 起始或讀取環境變數
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# user_info 的欄位
+USER_FIELDS = (
+    "user_id",
+    "name",
+    "idNumber",
+    "tel",
+    "steptype",
+    "step",
+    "errcount",
+    "register",
+)
+
+
+# 從資料庫讀取時只取 user_info 的欄位
+PROJECTION = {"_id": 0, **{field: 1 for field in USER_FIELDS}}
+
+
+# 找出兩份資料中有改變的欄位，沒有舊資料時全部都算
+def changed_fields(old, new) -> dict:
+    if old is None:
+        return {key: value for key, value in new.items() if key != "_id"}
+    return {
+        key: value
+        for key, value in new.items()
+        if key != "_id" and (key not in old or old[key] != value)
+    }
+
+
+# 儲存後端的介面，每種儲存方式都要實作這些方法
+class Backend:
+    name = "base"
+
+    def get(self, userID: str):
+        raise NotImplementedError
+
+    # 取得使用者資料，沒有的話用 default 建立並回傳
+    def get_or_create(self, userID: str, default):
+        raise NotImplementedError
+
+    def put(self, userID: str, data):
+        raise NotImplementedError
+
+    def delete(self, userID: str):
+        raise NotImplementedError
+
+    # 一次讀取多個使用者，回傳 {user_id: 資料}，找不到的不會出現在結果中
+    def get_many(self, userIDs) -> dict:
+        result = {}
+        for userID in userIDs:
+            data = self.get(userID)
+            if data is not None:
+                result[userID] = data
+        return result
+
+    # 一次寫入多個使用者，items 是 {user_id: 資料}
+    def put_many(self, items: dict):
+        for userID, data in items.items():
+            self.put(userID, data)
+
+    # 清掉只存在這個行程中的資料，預設沒有
+    def forget(self, userID: str):
+        pass
+
+    # 記錄處理過的事件，保留 ttl 秒，第一次記錄時回傳 True
+    # 預設沒有共用的儲存，一律當作第一次
+    def mark_event(self, eventID: str, ttl: float) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+# 記憶體中的一筆使用者資料，用固定欄位代替 dict 比較省記憶體
+class UserRecord:
+    __slots__ = USER_FIELDS + ("extra", "last_seen")
+
+    def __init__(self, data):
+        for field in USER_FIELDS:
+            setattr(self, field, data.get(field))
+        # 不在固定欄位內的資料，通常不會有
+        extra = {key: value for key, value in data.items() if key not in USER_FIELDS}
+        self.extra = extra or None
+        self.last_seen = time.monotonic()
+
+    def to_dict(self) -> dict:
+        data = {field: getattr(self, field) for field in USER_FIELDS}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def size(self) -> int:
+        total = sys.getsizeof(self)
+        for field in USER_FIELDS:
+            total += sys.getsizeof(getattr(self, field))
+        if self.extra:
+            total += sys.getsizeof(self.extra)
+        return total
+
+
+# 有上限的記憶體資料表
+class MemoryStore(Backend):
+    name = "memory"
+    # 超過上限時，每次寫入最多保留幾個還在流程中的使用者
+    MAX_SKIPS = 16
+
+    def __init__(self, max_size: int = 10000, idle_timeout: float = 86400, sweep_interval: float = 60):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        # 依照最後使用的時間排列，最前面是最久沒用到的
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+        self.evicted = 0
+        self.last_sweep = time.monotonic()
+
+    def __contains__(self, userID) -> bool:
+        return userID in self.records
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, userID: str):
+        with self.lock:
+            record = self.records.get(userID)
+            if record is None:
+                return None
+            record.last_seen = time.monotonic()
+            self.records.move_to_end(userID)
+            return record.to_dict()
+
+    def get_or_create(self, userID: str, default):
+        with self.lock:
+            record = self.records.get(userID)
+            if record is None:
+                record = self.records[userID] = UserRecord(default)
+                self._evict()
+            else:
+                record.last_seen = time.monotonic()
+                self.records.move_to_end(userID)
+            return record.to_dict()
+
+    def put(self, userID: str, data):
+        with self.lock:
+            self.records[userID] = UserRecord(data)
+            self.records.move_to_end(userID)
+            self._evict()
+
+    def delete(self, userID: str):
+        with self.lock:
+            self.records.pop(userID, None)
+
+    def forget(self, userID: str):
+        self.delete(userID)
+
+    # 超過上限時移除最久沒用到的使用者
+    # 還在流程中、也還沒閒置太久的使用者先移到後面保留，每次寫入最多跳過 MAX_SKIPS 個，
+    # 之後就直接移除最前面的，使用者數不會超過上限
+    # 閒置太久的使用者 (包含流程中的) 每 sweep_interval 秒清一次
+    # 呼叫時必須持有 lock
+    def _evict(self):
+        now = time.monotonic()
+        skips = self.MAX_SKIPS
+        while len(self.records) > self.max_size:
+            userID, record = next(iter(self.records.items()))
+            if (
+                skips > 0
+                and record.steptype is not None
+                and now - record.last_seen <= self.idle_timeout
+            ):
+                self.records.move_to_end(userID)
+                skips -= 1
+                continue
+            del self.records[userID]
+            self.evicted += 1
+
+        if now - self.last_sweep >= self.sweep_interval:
+            self.last_sweep = now
+            while self.records:
+                userID, record = next(iter(self.records.items()))
+                if now - record.last_seen <= self.idle_timeout:
+                    break
+                del self.records[userID]
+                self.evicted += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            approx_bytes = sys.getsizeof(self.records)
+            for userID, record in self.records.items():
+                approx_bytes += sys.getsizeof(userID) + record.size()
+            return {
+                "backend": self.name,
+                "entries": len(self.records),
+                "max_size": self.max_size,
+                "evicted": self.evicted,
+                "approx_bytes": approx_bytes,
+            }
+
+
+# 存在 MongoDB
+class MongoBackend(Backend):
+    name = "mongo"
+    # 記住最近讀寫過的資料，用來找出更新時有改變的欄位
+    SNAPSHOT_SIZE = 10000
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.snapshots = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _remember(self, userID: str, data):
+        with self.lock:
+            self.snapshots[userID] = dict(data)
+            self.snapshots.move_to_end(userID)
+            if len(self.snapshots) > self.SNAPSHOT_SIZE:
+                self.snapshots.popitem(last=False)
+
+    def _changes(self, userID: str, data) -> dict:
+        with self.lock:
+            old = self.snapshots.get(userID)
+        return changed_fields(old, data)
+
+    # 建立索引，每個索引分開建立，其中一個失敗不會影響其他的
+    def ensure_indexes(self):
+        # user_id 的唯一索引，已經有重複資料時會建立失敗，要先清掉重複的使用者資料
+        try:
+            self.collection.create_index("user_id", unique=True)
+        except DuplicateKeyError as e:
+            logger.error(
+                f"Duplicate user_id documents, unique index not created: {e}",
+                extra={"collection": self.collection.name},
+            )
+        except OperationFailure as e:
+            logger.error(f"Error while creating user_id index: {e}")
+
+        # 處理過的事件到了 expires_at 就由 MongoDB 自動刪除
+        try:
+            self.events.create_index("expires_at", expireAfterSeconds=0)
+        except OperationFailure as e:
+            logger.error(f"Error while creating events TTL index: {e}")
+
+    # 處理過的事件放在另一個 collection，webhookEventId 當作 _id
+    @property
+    def events(self):
+        return self.collection.database[self.collection.name + "_events"]
+
+    def mark_event(self, eventID: str, ttl: float) -> bool:
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=ttl
+        )
+        try:
+            self.events.insert_one({"_id": eventID, "expires_at": expires_at})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def get(self, userID: str):
+        result = self.collection.find_one({"user_id": userID}, PROJECTION)
+        if result is not None:
+            self._remember(userID, result)
+        return result
+
+    # 只需要一次來回，同時建立時靠唯一索引避免重複
+    def get_or_create(self, userID: str, default):
+        doc = {key: value for key, value in default.items() if key != "_id"}
+        result = None
+        for _ in range(2):
+            try:
+                result = self.collection.find_one_and_update(
+                    {"user_id": userID},
+                    {"$setOnInsert": doc},
+                    projection=PROJECTION,
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+                break
+            except DuplicateKeyError:
+                # 兩個請求同時建立同一個使用者，再查一次就會拿到另一邊建立的資料
+                continue
+        if result is None:
+            result = self.collection.find_one({"user_id": userID}, PROJECTION)
+        self._remember(userID, result)
+        return result
+
+    def put(self, userID: str, data):
+        changes = self._changes(userID, data)
+        if changes:
+            self.collection.update_one({"user_id": userID}, {"$set": changes}, upsert=True)
+        self._remember(userID, data)
+
+    def delete(self, userID: str):
+        self.collection.delete_one({"user_id": userID})
+        with self.lock:
+            self.snapshots.pop(userID, None)
+
+    def get_many(self, userIDs) -> dict:
+        result = {}
+        for doc in self.collection.find({"user_id": {"$in": list(userIDs)}}, PROJECTION):
+            result[doc["user_id"]] = doc
+            self._remember(doc["user_id"], doc)
+        return result
+
+    def put_many(self, items: dict):
+        requests = []
+        for userID, data in items.items():
+            changes = self._changes(userID, data)
+            if changes:
+                requests.append(
+                    UpdateOne({"user_id": userID}, {"$set": changes}, upsert=True)
+                )
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+        for userID, data in items.items():
+            self._remember(userID, data)
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "pool": pool_monitor.stats()}
+
+
+# 存在本機的 SQLite 檔案，WAL 模式下多個行程可以同時讀，寫入時會短暫互斥
+class SqliteBackend(Backend):
+    name = "sqlite"
+    # SQLite 一次查詢可以帶的參數有上限
+    CHUNK_SIZE = 500
+
+    def __init__(self, path: str, busy_timeout: float = 5.0, pool_size: int = 8):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        # 連線放在有上限的連線池中輪流使用，不跟著執行緒，
+        # Flask 每個 request 一個新的執行緒也不會一直開新的連線
+        self.pool_size = max(1, pool_size)
+        self.pool = queue.LifoQueue()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.marked = 0
+
+        with self._connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_info ("
+                "user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS processed_events ("
+                "event_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+            )
+
+    def _open(self) -> sqlite3.Connection:
+        # isolation_level=None 表示自己控制交易
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # 從連線池借一條連線，用完放回去，連線都在使用中且已達上限時等待
+    @contextmanager
+    def _connection(self):
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self.lock:
+                if len(self.connections) < self.pool_size:
+                    conn = self._open()
+                    self.connections.append(conn)
+            if conn is None:
+                try:
+                    conn = self.pool.get(timeout=self.busy_timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("connection pool exhausted") from None
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            self.pool.put(conn)
+
+    @staticmethod
+    def _get(conn: sqlite3.Connection, userID: str):
+        row = conn.execute(
+            "SELECT data FROM user_info WHERE user_id = ?", (userID,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get(self, userID: str):
+        with self._connection() as conn:
+            return self._get(conn, userID)
+
+    def get_or_create(self, userID: str, default):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO user_info (user_id, data, updated_at) VALUES (?, ?, ?)",
+                (userID, json.dumps(default, ensure_ascii=False), time.time()),
+            )
+            return self._get(conn, userID)
+
+    def put(self, userID: str, data):
+        self.put_many({userID: data})
+
+    def delete(self, userID: str):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM user_info WHERE user_id = ?", (userID,))
+
+    def get_many(self, userIDs) -> dict:
+        userIDs = list(userIDs)
+        result = {}
+        with self._connection() as conn:
+            for index in range(0, len(userIDs), self.CHUNK_SIZE):
+                chunk = userIDs[index : index + self.CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                for userID, data in conn.execute(
+                    f"SELECT user_id, data FROM user_info WHERE user_id IN ({placeholders})",
+                    chunk,
+                ):
+                    result[userID] = json.loads(data)
+        return result
+
+    # 全部在同一個交易內寫入
+    def put_many(self, items: dict):
+        if not items:
+            return
+        now = time.time()
+        rows = [
+            (
+                userID,
+                json.dumps(
+                    {key: value for key, value in data.items() if key != "_id"},
+                    ensure_ascii=False,
+                ),
+                now,
+            )
+            for userID, data in items.items()
+        ]
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT INTO user_info (user_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET "
+                    "data = excluded.data, updated_at = excluded.updated_at",
+                    rows,
+                )
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    # 每記錄 CLEANUP_EVERY 個事件清一次過期的事件
+    CLEANUP_EVERY = 1000
+
+    def mark_event(self, eventID: str, ttl: float) -> bool:
+        now = time.time()
+        with self.lock:
+            self.marked += 1
+            cleanup = self.marked % self.CLEANUP_EVERY == 0
+        with self._connection() as conn:
+            if cleanup:
+                conn.execute("DELETE FROM processed_events WHERE expires_at < ?", (now,))
+            # 過期但還沒清掉的事件當作沒看過
+            cursor = conn.execute(
+                "INSERT INTO processed_events (event_id, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(event_id) DO UPDATE SET expires_at = excluded.expires_at "
+                "WHERE processed_events.expires_at < ?",
+                (eventID, now + ttl, now),
+            )
+            return cursor.rowcount == 1
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.pool = queue.LifoQueue()
+
+    def stats(self) -> dict:
+        with self._connection() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM user_info").fetchone()[0]
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "entries": entries,
+            "connections": len(self.connections),
+            "pool_size": self.pool_size,
+        }
+
+
+# 記錄從連線池取得連線要等多久，用來調整連線池大小
+class PoolMonitor(ConnectionPoolListener):
+    # 等待時間的區間上限，單位毫秒
+    BUCKETS = (1, 5, 10, 50, 100, 500, 1000, float("inf"))
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.buckets = [0] * len(self.BUCKETS)
+        self.open_connections = 0
+        self.in_use = 0
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.monotonic()
+
+    def connection_checked_out(self, event):
+        waited = (time.monotonic() - getattr(self.local, "started", time.monotonic())) * 1000
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            for index, bound in enumerate(self.BUCKETS):
+                if waited <= bound:
+                    self.buckets[index] += 1
+                    break
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.failed += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.open_connections -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "open_connections": self.open_connections,
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "checkout_failed": self.failed,
+                "checkout_wait_avg_ms": (
+                    self.wait_total / self.checkouts if self.checkouts else 0.0
+                ),
+                "checkout_wait_max_ms": self.wait_max,
+                "checkout_wait_buckets": {
+                    ("+Inf" if bound == float("inf") else str(bound)): count
+                    for bound, count in zip(self.BUCKETS, self.buckets)
+                },
+            }
+
+
+# 放在資料庫前面的 user_info 快取
+class SessionCache:
+    def __init__(
+        self,
+        backend: Backend,
+        mode: str = "write-through",
+        max_size: int = 10000,
+        ttl: float = 600,
+        max_staleness: float = 2.0,
+    ):
+        self.backend = backend
+        self.write_behind = mode == "write-behind"
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_staleness = max_staleness
+        # user_id -> [資料, 讀進來的時間, 第一次被改的時間 (None 表示已寫回)]
+        self.entries = OrderedDict()
+        # 還沒寫回的筆數，隨著修改一起更新，不用每次重新計算
+        self.dirty = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        # 統計資料
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.flushed_docs = 0
+        self.last_flush_lag = 0.0
+        self.max_flush_lag = 0.0
+
+        if self.write_behind:
+            self.thread = threading.Thread(
+                target=self._flush_loop, name="db-cache-flush", daemon=True
+            )
+            self.thread.start()
+
+    def _lookup(self, userID: str):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(userID)
+            if entry is not None and (entry[2] is not None or now - entry[1] < self.ttl):
+                self.entries.move_to_end(userID)
+                self.hits += 1
+                return dict(entry[0])
+            self.misses += 1
+        return None
+
+    def get(self, userID: str):
+        result = self._lookup(userID)
+        if result is not None:
+            return result
+
+        result = self.backend.get(userID)
+        if result is not None:
+            self._store(userID, result, dirty=False)
+        return result
+
+    def get_or_create(self, userID: str, default):
+        result = self._lookup(userID)
+        if result is not None:
+            return result
+
+        result = self.backend.get_or_create(userID, default)
+        self._store(userID, result, dirty=False)
+        return result
+
+    def put(self, userID: str, data):
+        if self.write_behind:
+            self._store(userID, data, dirty=True)
+        else:
+            self.backend.put(userID, data)
+            self._store(userID, data, dirty=False)
+
+    def delete(self, userID: str):
+        with self.lock:
+            entry = self.entries.pop(userID, None)
+            if entry is not None and entry[2] is not None:
+                self.dirty -= 1
+        self.backend.delete(userID)
+
+    # 移除已經寫回的資料，還沒寫回的保留
+    def forget(self, userID: str):
+        with self.lock:
+            entry = self.entries.get(userID)
+            if entry is not None and entry[2] is None:
+                del self.entries[userID]
+
+    def _store(self, userID: str, data, dirty: bool):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(userID)
+            dirty_since = entry[2] if entry is not None else None
+            if dirty:
+                if entry is not None and not changed_fields(entry[0], data):
+                    # 沒有任何改變，不需要寫回
+                    dirty = dirty_since is not None
+                elif dirty_since is None:
+                    dirty_since = now
+            self.dirty += int(dirty) - int(entry is not None and entry[2] is not None)
+            self.entries[userID] = [dict(data), now, dirty_since if dirty else None]
+            self.entries.move_to_end(userID)
+            overflow = len(self.entries) > self.max_size
+
+        if overflow:
+            self._evict()
+
+    # 超過上限時從最久沒用到的開始移除，還沒寫回的移到後面，等寫回後再移除
+    # 已經寫回的筆數不夠移除時才先寫回
+    def _evict(self):
+        with self.lock:
+            need_flush = self.dirty > self.max_size
+        if need_flush:
+            self.flush()
+        with self.lock:
+            # 每筆還沒寫回的最多跳過一次
+            skips = self.dirty
+            while len(self.entries) > self.max_size:
+                userID, entry = next(iter(self.entries.items()))
+                if entry[2] is None:
+                    del self.entries[userID]
+                elif skips > 0:
+                    self.entries.move_to_end(userID)
+                    skips -= 1
+                else:
+                    break
+
+    # 把改過的資料一次寫回資料庫
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                dirty = [
+                    (userID, entry[0], entry[2])
+                    for userID, entry in self.entries.items()
+                    if entry[2] is not None
+                ]
+            if not dirty:
+                return
+
+            self.backend.put_many({userID: data for userID, data, _ in dirty})
+
+            now = time.monotonic()
+            with self.lock:
+                for userID, data, dirty_since in dirty:
+                    entry = self.entries.get(userID)
+                    # 寫回的期間又被改過就保持 dirty，下次再寫
+                    if entry is not None and entry[2] == dirty_since and entry[0] == data:
+                        entry[2] = None
+                        self.dirty -= 1
+                lag = now - min(dirty_since for _, _, dirty_since in dirty)
+                self.last_flush_lag = lag
+                self.max_flush_lag = max(self.max_flush_lag, lag)
+                self.flushes += 1
+                self.flushed_docs += len(dirty)
+
+    def _flush_loop(self):
+        interval = max(0.05, self.max_staleness / 2)
+        while not self.stop_event.wait(interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error while flushing cache: {e}")
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(5)
+        self.flush()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "mode": "write-behind" if self.write_behind else "write-through",
+                "entries": len(self.entries),
+                "dirty": self.dirty,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "flushes": self.flushes,
+                "flushed_docs": self.flushed_docs,
+                "last_flush_lag_ms": self.last_flush_lag * 1000,
+                "max_flush_lag_ms": self.max_flush_lag * 1000,
+            }
+
+
 # 定義全域變數
-collection = None
-user_map = {}
+db_client = None
+pool_monitor = PoolMonitor()
+backend = MemoryStore(
+    max_size=int(os.getenv("MEMORY_STORE_SIZE", 10000)),
+    idle_timeout=float(os.getenv("MEMORY_STORE_IDLE", 86400)),
+)
+cache = None
+
+
+# 讀寫時要經過的物件，有快取就先經過快取
+def _store():
+    return cache if cache is not None else backend
 
 
 # 插入資料
+@metrics.timed("persistence")
 def insert_data(userID: str, data: any):
-    global collection
-    if collection != None:
-        collection.insert_one(data)
-    else:
-        user_map[userID] = data
+    _store().put(userID, data)
 
 
 # 查詢資料
+@metrics.timed("persistence")
 def query_data(userID: str):
-    global collection
-    if collection != None:
-        result = collection.find_one({"user_id": userID})
-        return result
-    else:
-        if userID in user_map:
-            return user_map[userID]
+    return _store().get(userID)
 
-    return None
+
+# 取得使用者資料，沒有的話用 default 建立並回傳
+@metrics.timed("persistence")
+def get_or_create(userID: str, default):
+    return _store().get_or_create(userID, default)
 
 
 # 更新文件
+@metrics.timed("persistence")
 def update_data(userID: str, data):
-    global collection
-    if collection != None:
-        collection.update_one({"user_id": userID}, {"$set": data})
-    else:
-        user_map[userID] = data
+    _store().put(userID, data)
 
 
 # 刪除文件
+@metrics.timed("persistence")
 def delete_data(userID: str):
-    global collection
-    if collection != None:
-        collection.delete_one({"user_id": userID})
+    _store().delete(userID)
+
+
+# 一次查詢多個使用者
+@metrics.timed("persistence")
+def get_many(userIDs) -> dict:
+    if cache is None:
+        return backend.get_many(userIDs)
+
+    result = {}
+    missing = []
+    for userID in userIDs:
+        data = cache._lookup(userID)
+        if data is not None:
+            result[userID] = data
+        else:
+            missing.append(userID)
+    for userID, data in backend.get_many(missing).items():
+        cache._store(userID, data, dirty=False)
+        result[userID] = data
+    return result
+
+
+# 一次更新多個使用者
+@metrics.timed("persistence")
+def put_many(items: dict):
+    if cache is None:
+        backend.put_many(items)
     else:
-        if userID in user_map:
-            del user_map[userID]
+        for userID, data in items.items():
+            cache.put(userID, data)
+
+
+# 使用者取消好友時，清掉暫存在記憶體中的資料 (不會刪除資料庫內的資料)
+def forget_user(userID: str):
+    if cache is not None:
+        cache.forget(userID)
+    backend.forget(userID)
+
+
+# 記錄處理過的 webhook 事件，第一次記錄時回傳 True
+@metrics.timed("persistence")
+def mark_event(eventID: str, ttl: float) -> bool:
+    return backend.mark_event(eventID, ttl)
+
+
+# 儲存後端的狀態，記憶體儲存會回報筆數與大約使用的記憶體
+def backend_stats() -> dict:
+    return backend.stats()
+
+
+# 快取的命中率與寫回延遲
+def cache_stats() -> dict:
+    if cache is None:
+        return {"mode": "off"}
+    return cache.stats()
+
+
+# 連線池的統計資料
+def pool_stats() -> dict:
+    return pool_monitor.stats()
+
+
+def close_db():
+    if cache is not None:
+        cache.close()
+    backend.close()
+    if db_client is not None:
+        db_client.close()
+
+
+atexit.register(close_db)
+
+
+# 依照環境變數建立 MongoClient，這時還不會真的連線
+def create_client(dbHost: str) -> MongoClient:
+    options = {
+        "maxPoolSize": int(os.getenv("DB_MAX_POOL_SIZE", 100)),
+        "minPoolSize": int(os.getenv("DB_MIN_POOL_SIZE", 0)),
+        "serverSelectionTimeoutMS": int(os.getenv("DB_SERVER_SELECTION_TIMEOUT_MS", 2000)),
+        "connectTimeoutMS": int(os.getenv("DB_CONNECT_TIMEOUT_MS", 2000)),
+        "socketTimeoutMS": int(os.getenv("DB_SOCKET_TIMEOUT_MS", 5000)),
+        "readPreference": os.getenv("DB_READ_PREFERENCE", "primary"),
+        "event_listeners": [pool_monitor],
+        "connect": False,
+    }
+    waitQueueTimeout = os.getenv("DB_WAIT_QUEUE_TIMEOUT_MS")
+    if waitQueueTimeout:
+        options["waitQueueTimeoutMS"] = int(waitQueueTimeout)
+    writeConcern = os.getenv("DB_WRITE_CONCERN")
+    if writeConcern:
+        options["w"] = int(writeConcern) if writeConcern.isdigit() else writeConcern
+    return MongoClient(dbHost, **options)
+
+
+# 先 ping 資料庫，並同時開幾條連線放進連線池
+def warm_up(dbClient: MongoClient):
+    dbClient.admin.command("ping")
+    connections = int(os.getenv("DB_WARMUP_CONNECTIONS", os.getenv("DB_MIN_POOL_SIZE", 0)))
+    if connections > 1:
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            for future in [
+                executor.submit(dbClient.admin.command, "ping") for _ in range(connections)
+            ]:
+                future.result()
+
+
+# 連線 MongoDB，連不上時回傳 None
+def init_mongo():
+    global db_client
+    dbHost = os.getenv("DBHOST")
+    if dbHost == None:
+        return None
+
+    dbClient = create_client(dbHost)
+    try:
+        warm_up(dbClient)
+    except PyMongoError as e:
+        # 資料庫連不上，改用記憶體儲存
+        logger.warning(f"Database unreachable, using memory store: {e}")
+        dbClient.close()
+        return None
+    db_client = dbClient
+    dbName = os.getenv("dbName")
+    database = dbClient[dbName]
+    collectionName = os.getenv("collectionName")
+    mongo = MongoBackend(database[collectionName])
+    mongo.ensure_indexes()
+    return mongo
+
 
 # 起始資料庫
 def init_db():
-    global collection
+    global backend
     enable_db = os.getenv("ENABLE_DB", "false")
-    if enable_db.lower() == "true":
-        dbHost = os.getenv("DBHOST")
-        if dbHost != None:
-            dbClient = MongoClient(dbHost)
-            dbName = os.getenv("dbName")
-            database = dbClient[dbName]
-            collectionName = os.getenv("collectionName")
-            collection = database[collectionName]
+    default_backend = "mongo" if enable_db.lower() == "true" else "memory"
+    backend_name = os.getenv("DB_BACKEND", default_backend).lower()
+
+    selected = None
+    if backend_name == "mongo":
+        selected = init_mongo()
+    elif backend_name == "sqlite":
+        selected = SqliteBackend(
+            os.getenv("SQLITE_PATH", "bot_data.sqlite3"),
+            pool_size=int(os.getenv("SQLITE_POOL_SIZE", 8)),
+        )
+
+    if selected is not None:
+        backend = selected
+        init_cache()
+
+
+def init_cache():
+    global cache
+    mode = os.getenv("DB_CACHE_MODE", "off").lower()
+    if mode in ("write-through", "write-behind"):
+        cache = SessionCache(
+            backend,
+            mode=mode,
+            max_size=int(os.getenv("DB_CACHE_SIZE", 10000)),
+            ttl=float(os.getenv("DB_CACHE_TTL", 600)),
+            max_staleness=float(os.getenv("DB_CACHE_MAX_STALENESS", 2.0)),
+        )
 
 
 def main():
@@ -79,4 +1024,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,330 @@
+"""
+主動推送訊息的佇列
+要推送的訊息先放進佇列，由背景執行緒在短時間內收集起來，
+內容相同的訊息合併成一次 multicast (最多 500 人)，只有一個人時才用 push，
+大量提醒 (例如提醒還沒集滿 15 點的會員) 時不用一個人呼叫一次 API
+
+送出前先從 token bucket 取得額度，不會超過 LINE 的速率限制，
+被回 429 時依照 Retry-After 或指數退避後重試
+
+環境變數 PUSH_PIPELINE 不是 true 時不啟用，push() 會直接同步送出
+
+"""
+
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from dotenv import load_dotenv
+from linebot.v3.messaging import MulticastRequest, PushMessageRequest
+from linebot.v3.messaging.exceptions import ApiException
+
+import line_client
+import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# multicast 一次最多的收件人數
+MAX_RECIPIENTS = 500
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.wait_total = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # 取得一個額度，不夠時等到有額度為止
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            self.wait_total += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+class PushPipeline:
+    def __init__(
+        self,
+        api_factory=line_client.get_api,
+        rate: float = 100.0,
+        burst: int = 20,
+        maxsize: int = 100000,
+        linger: float = 0.2,
+        max_retries: int = 5,
+        retry_backoff: float = 1.0,
+    ):
+        self.api_factory = api_factory
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = queue.Queue(maxsize=maxsize)
+        # 收集訊息的時間，越長越容易合併，但第一則訊息也會等越久
+        self.linger = linger
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.thread = None
+        self.started_at = None
+        self.lock = threading.Lock()
+
+        # 統計資料
+        self.enqueued = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.delivered = 0
+        self.failed = 0
+        self.push_calls = 0
+        self.multicast_calls = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="push-pipeline", daemon=True)
+        self.thread.start()
+
+    # 停止前會把佇列中的訊息送完
+    def stop(self, timeout: float = 10.0):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+    # 放入要推送給一個使用者的訊息，佇列滿了回傳 False
+    def push(self, user_id: str, messages: list) -> bool:
+        try:
+            self.queue.put_nowait((user_id, list(messages), time.monotonic()))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.enqueued += 1
+        return True
+
+    # 同樣的訊息推送給多個使用者，回傳成功放進佇列的人數
+    def multicast(self, user_ids, messages: list) -> int:
+        count = 0
+        for user_id in user_ids:
+            if self.push(user_id, messages):
+                count += 1
+        return count
+
+    # 內容相同的訊息視為同一組
+    @staticmethod
+    def _key(messages: list) -> str:
+        return json.dumps([message.to_dict() for message in messages], sort_keys=True)
+
+    # 收集 linger 秒內的訊息，依內容分組
+    # 同一個人在這一輪已經有訊息時，之後的訊息放到下一輪，
+    # 每一輪依序送完才送下一輪，同一個人的訊息會照放入的順序送出
+    def _collect(self, first) -> tuple[list, bool]:
+        rounds = [({}, set())]
+        stopping = False
+        deadline = time.monotonic() + self.linger
+        item = first
+        while True:
+            user_id, messages, enqueued_at = item
+            groups, users = rounds[-1]
+            if user_id in users:
+                groups, users = {}, set()
+                rounds.append((groups, users))
+            users.add(user_id)
+            key = self._key(messages)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (messages, {})
+            group[1][user_id] = enqueued_at
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+        return [groups for groups, _ in rounds], stopping
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            rounds, stopping = self._collect(item)
+            with self.lock:
+                self.in_flight = sum(
+                    len(recipients) for groups in rounds for _, recipients in groups.values()
+                )
+            for groups in rounds:
+                for messages, recipients in groups.values():
+                    user_ids = list(recipients)
+                    for index in range(0, len(user_ids), MAX_RECIPIENTS):
+                        chunk = user_ids[index : index + MAX_RECIPIENTS]
+                        self._send(chunk, messages, [recipients[u] for u in chunk])
+            if stopping:
+                return
+
+    def _call(self, line_bot_api, user_ids: list, messages: list):
+        if len(user_ids) == 1:
+            with metrics.track("line", "push"):
+                line_bot_api.push_message_with_http_info(
+                    PushMessageRequest(to=user_ids[0], messages=messages)
+                )
+            with self.lock:
+                self.push_calls += 1
+        else:
+            with metrics.track("line", "multicast"):
+                line_bot_api.multicast_with_http_info(
+                    MulticastRequest(to=user_ids, messages=messages)
+                )
+            with self.lock:
+                self.multicast_calls += 1
+
+    # 送出一批，429 時退避後重試
+    def _send(self, user_ids: list, messages: list, enqueued_at: list):
+        line_bot_api = self.api_factory()
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                self._call(line_bot_api, user_ids, messages)
+                break
+            except ApiException as e:
+                if e.status != 429 or attempt >= self.max_retries:
+                    logger.error(f"Error during push: {e.status} {e.reason}")
+                    self._done(user_ids, enqueued_at, False)
+                    return
+                with self.lock:
+                    self.rate_limited += 1
+                    self.retries += 1
+                time.sleep(self._retry_after(e, attempt))
+                attempt += 1
+            except Exception as e:
+                logger.error(f"Error during push: {e}")
+                self._done(user_ids, enqueued_at, False)
+                return
+        self._done(user_ids, enqueued_at, True)
+
+    def _retry_after(self, error: ApiException, attempt: int) -> float:
+        headers = getattr(error, "headers", None) or {}
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            delay = self.retry_backoff * (2 ** attempt)
+            return delay + random.uniform(0, delay / 2)
+
+    def _done(self, user_ids: list, enqueued_at: list, success: bool):
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - len(user_ids))
+            if not success:
+                self.failed += len(user_ids)
+                return
+            self.delivered += len(user_ids)
+            for started in enqueued_at:
+                latency = now - started
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def stats(self) -> dict:
+        with self.lock:
+            elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+            calls = self.push_calls + self.multicast_calls
+            return {
+                "backlog": self.queue.qsize() + self.in_flight,
+                "enqueued": self.enqueued,
+                "rejected": self.rejected,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "push_calls": self.push_calls,
+                "multicast_calls": self.multicast_calls,
+                "recipients_per_call": round(self.delivered / calls, 2) if calls else 0.0,
+                "rate_limited": self.rate_limited,
+                "retries": self.retries,
+                "throughput": round(self.delivered / elapsed, 2) if elapsed else 0.0,
+                "latency_avg": (
+                    round(self.latency_total / self.delivered, 4) if self.delivered else 0.0
+                ),
+                "latency_max": round(self.latency_max, 4),
+                "rate_wait_total": round(self.bucket.wait_total, 4),
+            }
+
+
+pipeline = None
+
+
+def start() -> PushPipeline:
+    global pipeline
+    if pipeline is None:
+        pipeline = PushPipeline(
+            rate=float(os.getenv("PUSH_RATE", 100)),
+            burst=int(os.getenv("PUSH_BURST", 20)),
+            maxsize=int(os.getenv("PUSH_QUEUE_SIZE", 100000)),
+            linger=float(os.getenv("PUSH_LINGER", 0.2)),
+            max_retries=int(os.getenv("PUSH_MAX_RETRIES", 5)),
+            retry_backoff=float(os.getenv("PUSH_RETRY_BACKOFF", 1.0)),
+        )
+        pipeline.start()
+    return pipeline
+
+
+def stop():
+    global pipeline
+    if pipeline is not None:
+        pipeline.stop()
+        pipeline = None
+
+
+# 推送給一個使用者，沒有啟用佇列或佇列滿了就直接送出
+def push(user_id: str, messages: list, line_bot_api=None):
+    if pipeline is not None and pipeline.push(user_id, messages):
+        return
+    line_bot_api = line_bot_api or line_client.get_api()
+    with metrics.track("line", "push"):
+        line_bot_api.push_message_with_http_info(
+            PushMessageRequest(to=user_id, messages=list(messages))
+        )
+
+
+# 同樣的訊息推送給多個使用者
+def multicast(user_ids, messages: list):
+    if pipeline is not None:
+        pipeline.multicast(user_ids, messages)
+        return
+    user_ids = list(user_ids)
+    line_bot_api = line_client.get_api()
+    for index in range(0, len(user_ids), MAX_RECIPIENTS):
+        with metrics.track("line", "multicast"):
+            line_bot_api.multicast_with_http_info(
+                MulticastRequest(
+                    to=user_ids[index : index + MAX_RECIPIENTS], messages=list(messages)
+                )
+            )
+
+
+def stats() -> dict:
+    if pipeline is None:
+        return {"enabled": False}
+    return {"enabled": True, **pipeline.stats()}
@@ -0,0 +1,231 @@
+"""
+webhook 的流量限制
+每個使用者 (群組、聊天室) 各有一個 token bucket，全部的事件再共用一個，
+在讀取資料庫、呼叫後端之前就先檢查，超過時不處理這個事件：
+    RATE_LIMIT_ACTION=reply  回覆一則固定的提示 (同一個人每 RATE_LIMIT_NOTICE_INTERVAL 秒最多一次)
+    RATE_LIMIT_ACTION=drop   直接丟掉
+
+註冊流程中輸入錯誤 (errcount) 達到 RATE_LIMIT_ERRCOUNT 次的使用者，
+改用比較慢的速率 (RATE_LIMIT_ERRCOUNT_RATE)，避免卡住的使用者或程式一直送訊息
+
+預設不限制，RATE_LIMIT_ENABLED=true 時才啟用 (包含輸入錯誤的限制)，
+啟用前先依照尖峰時段的流量調整 RATE_LIMIT_GLOBAL_RATE / RATE_LIMIT_GLOBAL_BURST
+
+"""
+
+import heapq
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 檢查結果
+ALLOWED = "ok"
+SHED_USER = "user"
+SHED_GLOBAL = "global"
+SHED_ERRCOUNT = "errcount"
+
+NOTICES = {
+    SHED_USER: "訊息太多了，請稍後再試",
+    SHED_GLOBAL: "目前使用的人太多，請稍後再試",
+    SHED_ERRCOUNT: "輸入錯誤太多次，請稍後再試",
+}
+
+
+def source_key(event):
+    source = getattr(event, "source", None)
+    return (
+        getattr(source, "user_id", None)
+        or getattr(source, "group_id", None)
+        or getattr(source, "room_id", None)
+    )
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+    # 補充額度後取一個，不夠時回傳 False
+    def take(self, rate: float, burst: float, now: float) -> bool:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class _UserState:
+    __slots__ = ("bucket", "err_bucket", "shed", "notified_at")
+
+    def __init__(self, burst: float, now: float):
+        self.bucket = _Bucket(burst, now)
+        self.err_bucket = None
+        self.shed = 0
+        self.notified_at = 0.0
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        user_rate: float = 1.0,
+        user_burst: float = 5,
+        global_rate: float = 50.0,
+        global_burst: float = 100,
+        errcount_threshold: int = 5,
+        errcount_rate: float = 0.2,
+        notice_interval: float = 60,
+        max_users: int = 10000,
+        enabled: bool = True,
+    ):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.errcount_threshold = errcount_threshold
+        self.errcount_rate = errcount_rate
+        self.notice_interval = notice_interval
+        self.max_users = max_users
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.users = OrderedDict()
+        self.global_bucket = _Bucket(global_burst, time.monotonic())
+
+        # 統計資料
+        self.allowed = 0
+        self.shed = {SHED_USER: 0, SHED_GLOBAL: 0, SHED_ERRCOUNT: 0}
+        self.notices = 0
+
+    # 呼叫時必須持有 lock
+    def _state(self, key: str, now: float) -> _UserState:
+        state = self.users.get(key)
+        if state is None:
+            state = self.users[key] = _UserState(self.user_burst, now)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(key)
+        return state
+
+    def _reject(self, state: _UserState, reason: str) -> str:
+        self.shed[reason] += 1
+        if state is not None:
+            state.shed += 1
+        return reason
+
+    # 檢查一個事件，回傳 ALLOWED 或被擋下的原因
+    def check(self, key: str) -> str:
+        if not self.enabled:
+            return ALLOWED
+        now = time.monotonic()
+        with self.lock:
+            state = None
+            if key is not None:
+                state = self._state(key, now)
+                if not state.bucket.take(self.user_rate, self.user_burst, now):
+                    return self._reject(state, SHED_USER)
+            if not self.global_bucket.take(self.global_rate, self.global_burst, now):
+                return self._reject(state, SHED_GLOBAL)
+            self.allowed += 1
+            return ALLOWED
+
+    # 輸入錯誤太多次的使用者改用比較慢的速率
+    def check_errcount(self, key: str, errcount: int) -> str:
+        if not self.enabled or key is None or errcount < self.errcount_threshold:
+            return ALLOWED
+        now = time.monotonic()
+        with self.lock:
+            state = self._state(key, now)
+            if state.err_bucket is None:
+                state.err_bucket = _Bucket(1, now)
+            if state.err_bucket.take(self.errcount_rate, 1, now):
+                return ALLOWED
+            return self._reject(state, SHED_ERRCOUNT)
+
+    # 是否要回覆提示，同一個人在 notice_interval 秒內只提示一次
+    def should_notify(self, key: str) -> bool:
+        if key is None:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            state = self.users.get(key)
+            if state is None or now - state.notified_at < self.notice_interval:
+                return False
+            state.notified_at = now
+            self.notices += 1
+            return True
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.global_bucket
+            global_tokens = min(
+                self.global_burst, bucket.tokens + (now - bucket.updated) * self.global_rate
+            )
+            top = heapq.nlargest(
+                5, ((state.shed, key) for key, state in self.users.items() if state.shed)
+            )
+            return {
+                "enabled": self.enabled,
+                "user_rate": self.user_rate,
+                "user_burst": self.user_burst,
+                "global_rate": self.global_rate,
+                "global_burst": self.global_burst,
+                "global_tokens": round(global_tokens, 2),
+                "tracked_users": len(self.users),
+                "allowed": self.allowed,
+                "shed": dict(self.shed),
+                "notices": self.notices,
+                "top_shed": [{"source": key, "shed": shed} for shed, key in top],
+            }
+
+
+ACTION = os.getenv("RATE_LIMIT_ACTION", "reply").lower()
+
+limiter = RateLimiter(
+    user_rate=float(os.getenv("RATE_LIMIT_USER_RATE", 1.0)),
+    user_burst=float(os.getenv("RATE_LIMIT_USER_BURST", 5)),
+    global_rate=float(os.getenv("RATE_LIMIT_GLOBAL_RATE", 50)),
+    global_burst=float(os.getenv("RATE_LIMIT_GLOBAL_BURST", 100)),
+    errcount_threshold=int(os.getenv("RATE_LIMIT_ERRCOUNT", 5)),
+    errcount_rate=float(os.getenv("RATE_LIMIT_ERRCOUNT_RATE", 0.2)),
+    notice_interval=float(os.getenv("RATE_LIMIT_NOTICE_INTERVAL", 60)),
+    max_users=int(os.getenv("RATE_LIMIT_MAX_USERS", 10000)),
+    enabled=os.getenv("RATE_LIMIT_ENABLED", "false").lower() == "true",
+)
+
+
+# 只限制使用者送來的訊息和 postback，加入、封鎖好友等事件一定處理
+def limited(event) -> bool:
+    return hasattr(event, "message") or hasattr(event, "postback")
+
+
+# 檢查事件，回傳 ALLOWED 或被擋下的原因
+def check(event) -> str:
+    if not limited(event):
+        return ALLOWED
+    return limiter.check(source_key(event))
+
+
+def check_errcount(user_id: str, errcount: int) -> str:
+    return limiter.check_errcount(user_id, errcount or 0)
+
+
+# 被擋下時要回覆的提示，不需要回覆時回傳 None
+def notice(event, reason: str):
+    if ACTION != "reply" or not getattr(event, "reply_token", None):
+        return None
+    if not limiter.should_notify(source_key(event)):
+        return None
+    return NOTICES[reason]
+
+
+def stats() -> dict:
+    return {"action": ACTION, **limiter.stats()}
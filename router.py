@@ -0,0 +1,61 @@
+"""
+訊息與 postback 的路由表
+用 (steptype, step, 文字) 當 key 直接查 dict 找到處理函式，不用一路比對 if/elif，
+新增關鍵字或 postback 只要多註冊一個函式
+
+查詢順序：
+1. (steptype, step, 文字) 完全相同
+2. (steptype, 任何 step, 文字)
+3. (steptype, step, 任何文字)
+4. (steptype, 任何 step, 任何文字)
+
+每個路由被使用的次數會記錄下來，可以看出哪些流程最常用
+
+"""
+
+import threading
+
+# 任何 step 或任何文字
+ANY = "*"
+
+
+class Router:
+    def __init__(self, name: str):
+        self.name = name
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = 0
+
+    # 註冊處理函式，沒有指定文字時表示任何文字
+    def route(self, *texts, steptype=None, step=ANY):
+        def decorator(func):
+            for text in texts or (ANY,):
+                self.routes[(steptype, step, text)] = func
+            self.hits.setdefault(func.__name__, 0)
+            return func
+
+        return decorator
+
+    def match(self, steptype, step, text):
+        routes = self.routes
+        return (
+            routes.get((steptype, step, text))
+            or routes.get((steptype, ANY, text))
+            or routes.get((steptype, step, ANY))
+            or routes.get((steptype, ANY, ANY))
+        )
+
+    # 找到處理函式就呼叫並回傳結果，找不到時回傳 None
+    def dispatch(self, steptype, step, text, *args):
+        func = self.match(steptype, step, text)
+        with self.lock:
+            if func is None:
+                self.misses += 1
+                return None
+            self.hits[func.__name__] += 1
+        return func(*args)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": dict(self.hits), "misses": self.misses}
@@ -0,0 +1,377 @@
+"""
+集點 (/add/*) 的用戶端
+- 同一個使用者在短時間內重複按同一個集點項目 (連點兩下)，只會送出一次累加，
+  後來的請求直接拿第一次的結果
+- 記住每個使用者各項目最新的點數
+- STAMP_OPTIMISTIC 為 true 時，有記住的點數就先用「目前點數 + 1」回覆，
+  後端在背景確認，結果不同時再呼叫 on_reconcile 補送更正，並記錄不一致的次數
+
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import backend_client as backend
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 集點項目 -> 後端路徑，項目名稱同時也是回傳資料中點數的欄位
+CATEGORIES = {
+    "healthMeasurement": "/add/healthMeasurement",
+    "healthEducation": "/add/healthEducation",
+    "exercise": "/add/exercise",
+}
+
+
+class StampResult:
+    __slots__ = ("ok", "count", "status_code", "coalesced", "optimistic")
+
+    def __init__(self, ok: bool, count, status_code: int, coalesced=False, optimistic=False):
+        self.ok = ok
+        self.count = count
+        self.status_code = status_code
+        # 是否是和前一次請求合併的結果
+        self.coalesced = coalesced
+        # 是否是還沒經過後端確認的預估結果
+        self.optimistic = optimistic
+
+    def merged(self) -> "StampResult":
+        return StampResult(self.ok, self.count, self.status_code, True, self.optimistic)
+
+
+class _Flight:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class StampClient:
+    def __init__(
+        self,
+        window: float = 2.0,
+        max_users: int = 10000,
+        optimistic: bool = False,
+        confirm_workers: int = 4,
+        wait_timeout: float = 30.0,
+    ):
+        # 多久內的重複請求視為連點
+        self.window = window
+        self.max_users = max_users
+        self.optimistic = optimistic
+        self.executor = None
+        self.confirm_workers = confirm_workers
+        # 連點的第二下最多等第一下多久，超過就當作集點失敗
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        # user_id -> {"counts": {項目: 點數}, "recent": {項目: (時間, 結果)}}
+        self.users = OrderedDict()
+        self.inflight = {}
+        self.ainflight = {}
+        self.tasks = set()
+
+        # 統計資料
+        self.requests = 0
+        self.backend_calls = 0
+        self.coalesced = 0
+        self.optimistic_replies = 0
+        self.confirmed = 0
+        self.divergences = 0
+        self.divergence_total = 0
+        self.wait_timeouts = 0
+
+    def _entry(self, user_id: str) -> dict:
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = self.users[user_id] = {"counts": {}, "recent": {}}
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+        return entry
+
+    # 目前記住的點數，沒有時回傳 None
+    def cached_count(self, user_id: str, category: str):
+        with self.lock:
+            entry = self.users.get(user_id)
+            return None if entry is None else entry["counts"].get(category)
+
+    # 把點數設成已知的值，例如從其他地方查到最新點數時
+    def set_count(self, user_id: str, category: str, count: int):
+        with self.lock:
+            self._entry(user_id)["counts"][category] = count
+
+    def forget(self, user_id: str):
+        with self.lock:
+            self.users.pop(user_id, None)
+
+    # 在 window 內的上一次結果，呼叫時必須持有 lock
+    def _recent(self, user_id: str, category: str):
+        entry = self.users.get(user_id)
+        if entry is None:
+            return None
+        recent = entry["recent"].get(category)
+        if recent is None or time.monotonic() - recent[0] >= self.window:
+            return None
+        return recent[1]
+
+    # 只記住成功的結果，失敗時連點的第二下可以重新嘗試
+    def _remember(self, user_id: str, category: str, result: StampResult):
+        if not result.ok:
+            return
+        entry = self._entry(user_id)
+        entry["recent"][category] = (time.monotonic(), result)
+        if not result.optimistic:
+            entry["counts"][category] = result.count
+
+    @staticmethod
+    def _result(category: str, response) -> StampResult:
+        if response.status_code != 200:
+            return StampResult(False, None, response.status_code)
+        return StampResult(True, response.json().get(category), response.status_code)
+
+    def _call(self, user_id: str, category: str) -> StampResult:
+        with self.lock:
+            self.backend_calls += 1
+        try:
+            response = backend.put(CATEGORIES[category], json={"lineId": user_id})
+            return self._result(category, response)
+        except Exception as e:
+            # 後端沒有回應、斷路器打開或回應不是 JSON，當作集點失敗
+            logger.error(f"Error during request: {e}")
+            return StampResult(False, None, 0)
+
+    # 累加一點，on_reconcile(user_id, 確認後的結果) 只在先用預估結果回覆且結果不同時呼叫
+    def add(self, user_id: str, category: str, on_reconcile=None) -> StampResult:
+        key = (user_id, category)
+        with self.lock:
+            self.requests += 1
+            recent = self._recent(user_id, category)
+            if recent is not None:
+                self.coalesced += 1
+                return recent.merged()
+
+            flight = self.inflight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                flight = self.inflight[key] = _Flight()
+                leader = True
+
+            cached = self.users.get(user_id, {}).get("counts", {}).get(category)
+            if leader and self.optimistic and cached is not None:
+                predicted = StampResult(True, cached + 1, 200, optimistic=True)
+                self._remember(user_id, category, predicted)
+                self.optimistic_replies += 1
+                self._get_executor().submit(
+                    self._confirm, user_id, category, flight, predicted, on_reconcile
+                )
+                return predicted
+
+        if not leader:
+            if not flight.event.wait(self.wait_timeout):
+                return self._wait_timed_out(user_id, category)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result.merged()
+
+        try:
+            result = self._call(user_id, category)
+        except Exception as e:
+            self._land(key, flight, None, e)
+            raise
+        self._land(key, flight, result, None)
+        return result
+
+    def _wait_timed_out(self, user_id: str, category: str) -> StampResult:
+        logger.warning(
+            "Timed out waiting for stamp request",
+            extra={"user_id": user_id, "category": category},
+        )
+        with self.lock:
+            self.wait_timeouts += 1
+        return StampResult(False, None, 0, coalesced=True)
+
+    def _land(self, key: tuple, flight: _Flight, result, error):
+        with self.lock:
+            if result is not None:
+                self._remember(key[0], key[1], result)
+            self.inflight.pop(key, None)
+        flight.result = result
+        flight.error = error
+        flight.event.set()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.confirm_workers, thread_name_prefix="stamp-confirm"
+            )
+        return self.executor
+
+    # 背景確認預估的結果，不論成功與否都要 _land，否則之後同一個項目的請求會一直等下去
+    def _confirm(self, user_id, category, flight, predicted, on_reconcile):
+        key = (user_id, category)
+        result = None
+        error = None
+        try:
+            result = self._call(user_id, category)
+        except Exception as e:
+            logger.error(f"Error while confirming stamp: {e}")
+            error = e
+            return
+        finally:
+            self._land(key, flight, result, error)
+        if self._diverged(predicted, result) and on_reconcile is not None:
+            try:
+                on_reconcile(user_id, result)
+            except Exception as e:
+                logger.error(f"Error during reconcile: {e}")
+
+    def _diverged(self, predicted: StampResult, result: StampResult) -> bool:
+        with self.lock:
+            self.confirmed += 1
+            if result.ok and result.count == predicted.count:
+                return False
+            self.divergences += 1
+            if result.ok and result.count is not None:
+                self.divergence_total += abs(result.count - predicted.count)
+            return True
+
+    # async 版本，給 asgi_app 使用，on_reconcile 必須是 async 函式
+    async def aadd(self, user_id: str, category: str, on_reconcile=None) -> StampResult:
+        key = (user_id, category)
+        with self.lock:
+            self.requests += 1
+            recent = self._recent(user_id, category)
+            if recent is not None:
+                self.coalesced += 1
+                return recent.merged()
+
+            future = self.ainflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = self.ainflight[key] = asyncio.get_running_loop().create_future()
+                leader = True
+                cached = self.users.get(user_id, {}).get("counts", {}).get(category)
+                if self.optimistic and cached is not None:
+                    predicted = StampResult(True, cached + 1, 200, optimistic=True)
+                    self._remember(user_id, category, predicted)
+                    self.optimistic_replies += 1
+                    task = asyncio.create_task(
+                        self._aconfirm(user_id, category, future, predicted, on_reconcile)
+                    )
+                    # 保留參考避免 task 被回收
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                    return predicted
+
+        if not leader:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), self.wait_timeout)
+            except asyncio.TimeoutError:
+                return self._wait_timed_out(user_id, category)
+            return result.merged()
+
+        try:
+            result = await self._acall(user_id, category)
+        except Exception as e:
+            self._aland(key, future, None, e)
+            raise
+        self._aland(key, future, result, None)
+        return result
+
+    async def _acall(self, user_id: str, category: str) -> StampResult:
+        with self.lock:
+            self.backend_calls += 1
+        try:
+            response = await backend.aput(CATEGORIES[category], json={"lineId": user_id})
+            return self._result(category, response)
+        except Exception as e:
+            logger.error(f"Error during request: {e}")
+            return StampResult(False, None, 0)
+
+    def _aland(self, key: tuple, future, result, error):
+        with self.lock:
+            if result is not None:
+                self._remember(key[0], key[1], result)
+            self.ainflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+            # 沒有人在等時不要出現 "exception was never retrieved"
+            future.exception()
+        else:
+            future.set_result(result)
+
+    async def _aconfirm(self, user_id, category, future, predicted, on_reconcile):
+        result = None
+        error = None
+        try:
+            result = await self._acall(user_id, category)
+        except Exception as e:
+            logger.error(f"Error while confirming stamp: {e}")
+            error = e
+            return
+        finally:
+            if result is None and error is None:
+                # task 被取消
+                error = RuntimeError("stamp confirmation cancelled")
+            self._aland((user_id, category), future, result, error)
+        if self._diverged(predicted, result) and on_reconcile is not None:
+            try:
+                await on_reconcile(user_id, result)
+            except Exception as e:
+                logger.error(f"Error during reconcile: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "optimistic": self.optimistic,
+                "users": len(self.users),
+                "requests": self.requests,
+                "backend_calls": self.backend_calls,
+                "coalesced": self.coalesced,
+                "optimistic_replies": self.optimistic_replies,
+                "confirmed": self.confirmed,
+                "divergences": self.divergences,
+                "divergence_total": self.divergence_total,
+                "wait_timeouts": self.wait_timeouts,
+            }
+
+
+client = StampClient(
+    window=float(os.getenv("STAMP_COALESCE_WINDOW", 2.0)),
+    max_users=int(os.getenv("STAMP_CACHE_SIZE", 10000)),
+    optimistic=os.getenv("STAMP_OPTIMISTIC", "false").lower() == "true",
+    confirm_workers=int(os.getenv("STAMP_CONFIRM_WORKERS", 4)),
+    wait_timeout=float(os.getenv("STAMP_WAIT_TIMEOUT", 30)),
+)
+
+
+def add(user_id: str, category: str, on_reconcile=None) -> StampResult:
+    return client.add(user_id, category, on_reconcile)
+
+
+async def aadd(user_id: str, category: str, on_reconcile=None) -> StampResult:
+    return await client.aadd(user_id, category, on_reconcile)
+
+
+def forget(user_id: str):
+    client.forget(user_id)
+
+
+def stats() -> dict:
+    return client.stats()
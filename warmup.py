@@ -0,0 +1,234 @@
+"""
+集點後端與 LINE API 的預熱排程
+集點後端放在 Render 上，閒置一段時間會休眠，第一個使用者要等後端醒來，
+有時候久到 reply token 都過期了
+
+背景執行緒定時呼叫後端與 LINE，順便把連線池的連線先建好：
+- 忙碌時段 (WARMUP_BUSY_WINDOWS，例如 07:30-09:30,17:00-19:00) 開始前 WARMUP_LEAD 秒起，
+  每 WARMUP_BUSY_INTERVAL 秒預熱一次
+- 其他時間只在後端閒置超過 WARMUP_IDLE_INTERVAL 秒時預熱
+
+每次預熱的延遲超過 WARMUP_COLD_THRESHOLD 秒就算冷啟動，分別記錄冷啟動與一般的延遲
+
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import backend_client as backend
+import line_client
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+# "07:30-09:30,17:00-19:00" -> [(450, 570), (1020, 1140)]，單位是一天中的第幾分鐘
+def parse_windows(text: str) -> list:
+    windows = []
+    for part in (text or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, end = part.split("-")
+        windows.append((_minutes(start), _minutes(end)))
+    return windows
+
+
+def _minutes(text: str) -> int:
+    hour, minute = text.strip().split(":")
+    return int(hour) * 60 + int(minute)
+
+
+class LatencyStat:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 4) if self.count else 0.0,
+            "max": round(self.max, 4),
+        }
+
+
+class WarmupScheduler:
+    def __init__(
+        self,
+        windows: list = None,
+        lead: float = 300,
+        busy_interval: float = 240,
+        idle_interval: float = 600,
+        utc_offset: float = 8,
+        connections: int = 2,
+        cold_threshold: float = 2.0,
+        backend_path: str = "/",
+        timeout: float = 60,
+        tick: float = 30,
+    ):
+        self.windows = windows or []
+        self.lead = lead
+        self.busy_interval = busy_interval
+        self.idle_interval = idle_interval
+        # 忙碌時段用的時區 (相對 UTC 的小時數)
+        self.utc_offset = utc_offset
+        # 每次預熱同時送出幾個請求，把連線池的連線先建好
+        self.connections = max(1, connections)
+        self.cold_threshold = cold_threshold
+        self.backend_path = backend_path
+        # 後端醒來可能要幾十秒，timeout 要比平常長
+        self.timeout = timeout
+        self.tick = tick
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.last_run = 0.0
+
+        # 統計資料
+        self.runs = 0
+        self.failures = 0
+        self.latency = {
+            "backend": {"cold": LatencyStat(), "warm": LatencyStat()},
+            "line": {"cold": LatencyStat(), "warm": LatencyStat()},
+        }
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    # 現在 (加上 lead 秒後) 是否在忙碌時段內
+    def in_busy_window(self, now: float = None) -> bool:
+        now = time.time() if now is None else now
+        for moment in (now, now + self.lead):
+            local = time.gmtime(moment + self.utc_offset * 3600)
+            minute = local.tm_hour * 60 + local.tm_min
+            for start, end in self.windows:
+                if start <= minute < end or (start > end and (minute >= start or minute < end)):
+                    return True
+        return False
+
+    # 距離上次預熱或上次真的呼叫後端夠久了才需要預熱
+    def due(self) -> bool:
+        interval = self.busy_interval if self.in_busy_window() else self.idle_interval
+        idle = backend.idle_seconds()
+        since_run = time.monotonic() - self.last_run if self.last_run else None
+        quiet = [value for value in (idle, since_run) if value is not None]
+        return not quiet or min(quiet) >= interval
+
+    def _run(self):
+        while not self.stopped.is_set():
+            if self.due():
+                self.run_once()
+            self.stopped.wait(self.tick)
+
+    def _timed(self, target: str, func):
+        start = time.monotonic()
+        try:
+            func()
+        except Exception as e:
+            logger.warning(f"Warm-up {target} failed: {e}")
+            with self.lock:
+                self.failures += 1
+            return None
+        elapsed = time.monotonic() - start
+        kind = "cold" if elapsed >= self.cold_threshold else "warm"
+        with self.lock:
+            self.latency[target][kind].add(elapsed)
+        return elapsed
+
+    def _ping_backend(self):
+        response = backend.get(
+            self.backend_path, timeout=(backend.DEFAULT_TIMEOUT[0], self.timeout)
+        )
+        # 有回應就表示後端醒著，狀態碼不重要
+        response.close()
+
+    def _ping_line(self):
+        line_client.get_api().get_bot_info()
+
+    # 預熱一次，同時送出 connections 個請求建立連線
+    def run_once(self):
+        self.last_run = time.monotonic()
+        with self.lock:
+            self.runs += 1
+        # 先送一個把後端叫醒，醒了之後再補齊其他連線
+        self._timed("backend", self._ping_backend)
+        self._timed("line", self._ping_line)
+        if self.connections > 1:
+            with ThreadPoolExecutor(max_workers=self.connections - 1) as executor:
+                for _ in range(self.connections - 1):
+                    executor.submit(self._timed, "backend", self._ping_backend)
+                    executor.submit(self._timed, "line", self._ping_line)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "runs": self.runs,
+                "failures": self.failures,
+                "busy": self.in_busy_window(),
+                "last_run_ago": (
+                    round(time.monotonic() - self.last_run, 1) if self.last_run else None
+                ),
+                "latency": {
+                    target: {kind: stat.to_dict() for kind, stat in kinds.items()}
+                    for target, kinds in self.latency.items()
+                },
+            }
+
+
+scheduler = None
+
+
+# WARMUP_ENABLED 為 true 時啟動
+def start():
+    global scheduler
+    if os.getenv("WARMUP_ENABLED", "false").lower() != "true":
+        return None
+    if scheduler is None:
+        scheduler = WarmupScheduler(
+            windows=parse_windows(os.getenv("WARMUP_BUSY_WINDOWS", "")),
+            lead=float(os.getenv("WARMUP_LEAD", 300)),
+            busy_interval=float(os.getenv("WARMUP_BUSY_INTERVAL", 240)),
+            idle_interval=float(os.getenv("WARMUP_IDLE_INTERVAL", 600)),
+            utc_offset=float(os.getenv("WARMUP_UTC_OFFSET", 8)),
+            connections=int(os.getenv("WARMUP_CONNECTIONS", 2)),
+            cold_threshold=float(os.getenv("WARMUP_COLD_THRESHOLD", 2.0)),
+            backend_path=os.getenv("WARMUP_BACKEND_PATH", "/"),
+            timeout=float(os.getenv("WARMUP_TIMEOUT", 60)),
+        )
+        scheduler.start()
+    return scheduler
+
+
+def stop():
+    global scheduler
+    if scheduler is not None:
+        scheduler.stop()
+        scheduler = None
+
+
+def stats() -> dict:
+    if scheduler is None:
+        return {"enabled": False}
+    return {"enabled": True, **scheduler.stats()}